@@ -6,102 +6,295 @@ Modified to increase efficiency.
 
 import csv
 import os
-import statistics
+import functools
+import multiprocessing
 import numpy as np
-import pandas as pd
 
-import nltk
-from nltk import tokenize
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from nltk.stem.wordnet import WordNetLemmatizer
-
-lemmatizer = WordNetLemmatizer()
-stops = set(stopwords.words("english"))
+# nltk and pandas are imported where they are used, and the lexicon and NLTK
+# resources are loaded on first use, so importing this module (e.g. in pool
+# workers) is cheap and does not depend on the working directory.
 
 
 def has_capital_letters(index):
     return any(char.isupper() for char in index)
 
-anew_path = "EnglishShortened.csv"
-ANEW = pd.read_csv(anew_path, index_col='Word')
-ANEW.index = ANEW.index.map(str)
-ANEW = ANEW[~ANEW.index.map(has_capital_letters)]
-ANEW = ANEW.transpose().to_dict(orient='dict')
-# {word: {'valence': ..., 'arousal': ..., 'dominance': ...},}
+def load_lexicon(path):
+    """
+    Load ANEW as a word -> row index dict and a contiguous float32 (N, 3) 
+    array with the valence, arousal and dominance of each word.
+    """
+    import pandas as pd
+
+    anew = pd.read_csv(path, index_col='Word')
+    anew.index = anew.index.map(str)
+    anew = anew[~anew.index.map(has_capital_letters)]
+    index = {word: i for i, word in enumerate(anew.index)}
+    values = np.ascontiguousarray(anew[['valence', 'arousal', 'dominance']].to_numpy(dtype=np.float32))
+    return index, values
+
+anew_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "EnglishShortened.csv")
+
+
+@functools.lru_cache(maxsize=None)
+def get_lexicon(path=anew_path):
+    """
+    `load_lexicon(path)`, cached in binary form next to the CSV 
+    (<name>.vad.npy and <name>.vocab.txt) the first time and memory-mapped 
+    from there afterwards; rebuilt when the CSV is newer than the cache.
+    """
+    base = os.path.splitext(path)[0]
+    values_path, vocab_path = base + ".vad.npy", base + ".vocab.txt"
+
+    if os.path.exists(values_path) and os.path.exists(vocab_path) \
+            and os.path.getmtime(values_path) >= os.path.getmtime(path):
+        with open(vocab_path, 'r', encoding='utf-8') as f:
+            words = f.read().split('\n')
+        return {word: i for i, word in enumerate(words)}, np.load(values_path, mmap_mode='r')
+
+    index, values = load_lexicon(path)
+    try:
+        # words never contain newlines
+        with open(vocab_path + ".tmp", 'w', encoding='utf-8') as f:
+            f.write('\n'.join(index))
+        with open(values_path + ".tmp", 'wb') as f:
+            np.save(f, values)
+        os.replace(vocab_path + ".tmp", vocab_path)
+        os.replace(values_path + ".tmp", values_path)
+    except OSError:
+        # read-only checkout: keep using the in-memory lexicon
+        pass
+    return index, values
+
+
+@functools.lru_cache(maxsize=None)
+def get_stops():
+    from nltk.corpus import stopwords
+    return set(stopwords.words("english"))
+
+
+@functools.lru_cache(maxsize=None)
+def get_lemmatizer():
+    from nltk.stem.wordnet import WordNetLemmatizer
+    return WordNetLemmatizer()
+
+
+def __getattr__(name):
+    # lazily provide the former module-level globals
+    if name == "ANEW_INDEX":
+        return get_lexicon()[0]
+    if name == "ANEW_VALUES":
+        # ANEW_VALUES[ANEW_INDEX[word]] == [valence, arousal, dominance]
+        return get_lexicon()[1]
+    if name == "stops":
+        return get_stops()
+    if name == "lemmatizer":
+        return get_lemmatizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def score_words(ids, negated, agg=np.mean):
+    """
+    VAD scores of the lexicon rows `ids`; rows with `negated` set have their
+    polarity reversed (v -> 5 - (v - 5)). Returns (valence, arousal, 
+    dominance) aggregated with `agg`, or NaNs if `ids` is empty.
+    """
+    if len(ids) == 0:
+        return np.nan, np.nan, np.nan
+    values = get_lexicon()[1][ids].astype(np.float64)
+    values = np.where(np.asarray(negated)[:, None], 10 - values, values)
+    return aggregate(values, agg)
+
+
+def aggregate(values, agg=np.mean):
+    # aggregate the columns of an (n, 3) array
+    if agg is np.mean:
+        return tuple(values.mean(axis=0).tolist())
+    return tuple(float(agg(values[:, k])) for k in range(3))
+
+
+NEGATIONS = frozenset(['not', 'no', 'n\'t'])
+NEGATION_WINDOW = 3  # a word is negated if a negation is among the 3 words before it
+
+
+@functools.lru_cache(maxsize=None)
+def get_tagger():
+    # loaded once per process; nltk.pos_tag reloads the model on every call
+    from nltk.tag import PerceptronTagger
+    return PerceptronTagger()
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def lemmatize(word, pos):
+    """
+    Lemma of `word` given the first letter of its Penn Treebank tag (nouns 
+    and verbs are lemmatized, other words are returned unchanged). Memoized, 
+    since the same (word, pos) pairs keep recurring across a corpus.
+    """
+    if pos == 'N' or pos == 'V':
+        return get_lemmatizer().lemmatize(word, pos=pos.lower())
+    return word
 
 
-def analyze_sentence(sentence, agg=statistics.mean):
-    sentence = tokenize.word_tokenize(sentence.lower())
-    words = nltk.pos_tag(sentence)
+def match_words(tagged):
+    """
+    Lexicon rows of the words of a POS-tagged sentence (list of (word, tag) 
+    pairs) and whether each of them is negated. Returns (ids, negated).
+    """
+    anew_index = get_lexicon()[0]
+    stops = get_stops()
 
-    all_words = []
-    found_words = []
-    total_words = 0
-    v_list = []  # holds valence scores
-    a_list = []  # holds arousal scores
-    d_list = []  # holds dominance scores
+    ids = []  # lexicon rows of the found words
+    negated = []  # whether each found word is negated
+
+    # single forward scan: remember where the last negation was
+    last_negation = -NEGATION_WINDOW - 1
+    for index, (word, pos) in enumerate(tagged):
+        neg = index - last_negation <= NEGATION_WINDOW
+        # before the stop check: "not", "no" are stops and "n't" isn't alphabetic
+        if word in NEGATIONS:
+            last_negation = index
 
-    # search for each valid word's sentiment in ANEW
-    for index, p in enumerate(words):
         # don't process stops or words w/ punctuation
-        word = p[0]
-        pos = p[1]
         if word in stops or not word.isalpha():
             continue
 
-        # check for negation in 3 words before current word
-        j = index - 1
-        neg = False
-        while j >= 0 and j >= index - 3:
-            if words[j][0] == 'not' or words[j][0] == 'no' or words[j][0] == 'n\'t':
-                neg = True
-                break
-            j -= 1
+        # search for lemmatized word in ANEW
+        i = anew_index.get(lemmatize(word, pos[:1]).lower())
+        if i is not None:
+            ids.append(i)
+            negated.append(neg)
 
-        # lemmatize word based on pos
-        if pos[0] == 'N' or pos[0] == 'V':
-            lemma = lemmatizer.lemmatize(word, pos=pos[0].lower())
-        else:
-            lemma = word
+    return ids, negated
 
-        all_words.append(lemma)
 
-        # search for lemmatized word in ANEW
-        lemma = lemma.lower()
-        if lemma in ANEW:
-            row = ANEW[lemma]
-            v = float(row['valence'])
-            a = float(row['arousal'])
-            d = float(row['dominance'])
-            if neg:
-                # reverse polarity for this word
-                v = 5 - (v - 5)
-                a = 5 - (a - 5)
-                d = 5 - (d - 5)
-            v_list.append(v)
-            a_list.append(a)
-            d_list.append(d)
-    
-    if v_list == []:
-        return np.nan, np.nan, np.nan
+def tokenize_document(text):
+    # lower-cased word tokens of each sentence of `text`
+    import nltk
+    return [nltk.word_tokenize(sentence.lower()) for sentence in nltk.sent_tokenize(text)]
+
+
+def analyze_sentence(sentence, agg=np.mean):
+    import nltk
+
+    words = get_tagger().tag(nltk.word_tokenize(sentence.lower()))
+    return score_words(*match_words(words), agg)
+
+
+def analyze_tagged(documents, agg=np.mean):
+    """
+    (valence, arousal, dominance) of each document in `documents`, each a 
+    list of POS-tagged sentences (lists of (word, tag) pairs), e.g. the 
+    "tagged" view of a `corpus_store.CorpusStore`.
+    """
+    results = []
+    for document in documents:
+        if not document:
+            results.append((np.nan, np.nan, np.nan))
+            continue
+        # (n_sentences, 3): valence, arousal, dominance of each sentence
+        scores = np.array([score_words(*match_words(sentence)) for sentence in document])
+        results.append(aggregate(scores, agg))
+    return results
+
+
+def analyze_documents(texts, agg=np.mean):
+    """
+    `analyze_text` for each text in `texts`, with the sentences of all texts 
+    POS-tagged as one batch. Returns a list of (valence, arousal, dominance).
+    """
+    documents = [tokenize_document(str(text)) for text in texts]
+    tagged = iter(get_tagger().tag_sents([sentence for document in documents for sentence in document]))
+    return analyze_tagged([[next(tagged) for _ in document] for document in documents], agg)
+
+
+def analyze_text(text, agg=np.mean):
+    return analyze_documents([text], agg)[0]
+
+
+def _chunks(items, chunksize):
+    for start in range(0, len(items), chunksize):
+        yield items[start:start + chunksize]
+
+
+def analyze_texts(texts, agg=np.mean, n_jobs=1, chunksize=64, store=None):
+    """
+    `analyze_text` for each text in `texts`; returns a DataFrame with 
+    valence, arousal and dominance columns (indexed like `texts` if it is a 
+    Series). Texts are processed in chunks of `chunksize` (tagged as one 
+    batch), spread over `n_jobs` processes (None: all CPUs).
+
+    With a `corpus_store.CorpusStore` as `store`, the tagged sentences are 
+    read from its "tagged" view; only texts it doesn't have yet are tagged.
+    """
+    import pandas as pd
+
+    index = texts.index if isinstance(texts, pd.Series) else None
+    texts = [str(text) for text in texts]
+    n_jobs = n_jobs or os.cpu_count()
+
+    if store is not None:
+        keys = store.add(texts, ("tagged",), n_jobs, chunksize)
+        scores = np.array(analyze_tagged(store.view("tagged").documents(keys), agg), dtype=np.float64).reshape(-1, 3)
+        return pd.DataFrame(scores, columns=['valence', 'arousal', 'dominance'], index=index)
+
+    analyze = functools.partial(analyze_documents, agg=agg)
+    if n_jobs == 1:
+        results = map(analyze, _chunks(texts, chunksize))
+    else:
+        # build the lexicon cache before the workers race to write it
+        get_lexicon()
+        with multiprocessing.Pool(n_jobs) as pool:
+            results = pool.map(analyze, _chunks(texts, chunksize), chunksize=1)
+
+    scores = np.array([score for chunk in results for score in chunk], dtype=np.float64).reshape(-1, 3)
+    return pd.DataFrame(scores, columns=['valence', 'arousal', 'dominance'], index=index)
+
 
-    return agg(v_list), agg(a_list), agg(d_list)
+def make_synthetic_corpus(n_docs=1000, sentences_per_doc=10, words_per_sentence=15, seed=0):
+    """
+    Random documents mixing lexicon words, stop words and negations, for 
+    benchmarking.
+    """
+    rng = np.random.default_rng(seed)
+    vocab = np.array(list(get_lexicon()[0]) + sorted(get_stops()) + sorted(NEGATIONS - {'n\'t'}))
+    texts = []
+    for _ in range(n_docs):
+        words = rng.choice(vocab, size=(sentences_per_doc, words_per_sentence))
+        texts.append(' '.join(' '.join(sentence).capitalize() + '.' for sentence in words))
+    return texts
 
 
-def analyze_text(text, agg=statistics.mean):
-    sentences = nltk.sent_tokenize(text)
-    v_list, a_list, d_list = [], [], []
+def benchmark(n_docs=1000, n_jobs=None, chunksize=64, seed=0):
+    """
+    Throughput (documents / second) of the per-sentence path and of 
+    `analyze_texts` with 1 and `n_jobs` processes on a synthetic corpus.
+    """
+    import time
+    import nltk
 
-    for sentence in sentences:
-        v, a, d = analyze_sentence(sentence)
-        v_list.append(v)
-        a_list.append(a)
-        d_list.append(d)
+    texts = make_synthetic_corpus(n_docs, seed=seed)
+    n_jobs = n_jobs or os.cpu_count()
+    get_tagger()
+    get_stops()
 
-    # print(v_list, a_list, d_list)
-    # print(agg(v_list), agg(a_list), agg(d_list))
-    return agg(v_list), agg(a_list), agg(d_list)
+    def per_sentence(texts):
+        for text in texts:
+            np.array([analyze_sentence(sentence) for sentence in nltk.sent_tokenize(text)]).mean(axis=0)
 
+    timings = {}
+    runs = [("per sentence", lambda: per_sentence(texts)),
+            ("analyze_texts, 1 process", lambda: analyze_texts(texts, chunksize=chunksize))]
+    if n_jobs > 1:
+        runs.append((f"analyze_texts, {n_jobs} processes",
+                     lambda: analyze_texts(texts, n_jobs=n_jobs, chunksize=chunksize)))
+    for name, run in runs:
+        lemmatize.cache_clear()
+        start = time.perf_counter()
+        run()
+        timings[name] = n_docs / (time.perf_counter() - start)
+        print(f"{name}: {timings[name]:.1f} docs/s")
+    return timings
 
 
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,413 @@
+"""
+Benchmarks of the pipeline stages on synthetic news-like corpora.
+
+Every (stage, scale) pair runs in a fresh process, so that its peak RSS is
+its own. The corpus is generated in that process before the clock starts.
+Results (throughput, peak RSS, a scaling exponent per stage) are written as
+JSON. With --baseline, each result is compared with the same stage and scale
+in an earlier results file, and the exit status is 1 if any stage got slower
+by more than --tolerance.
+
+    python benchmark.py --scales 100,1000 --output bench.json
+    python benchmark.py --scales 100,1000 --baseline bench.json
+
+The zero-shot stage uses a stub classifier unless --zsc-model names a
+(small) Hugging Face model. The GPT stage talks to a local mock of the chat
+completions endpoint. Stages whose dependencies or NLTK data are missing are
+reported with status "error" and skipped in the comparison.
+"""
+
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import multiprocessing
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+STOPWORDS = [
+    "the", "of", "and", "to", "a", "in", "that", "is", "for", "it", "was", "on",
+    "with", "he", "she", "as", "at", "by", "this", "had", "not", "are", "but",
+    "from", "or", "have", "an", "they", "which", "were", "their", "been", "has",
+    "would", "will", "said", "its", "who", "no", "more",
+]
+
+
+def make_corpus(n_docs, seed=0, sentences=(5, 30), words=(8, 30)):
+    """
+    `n_docs` random articles: Zipf-distributed words (stop words first, then
+    ANEW lexicon words) in capitalized sentences, with some commas,
+    numbers, negations and urls.
+    """
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(ROOT, "VAD", "EnglishShortened.csv"), 'r', encoding='utf-8') as f:
+        lexicon = [line.split(',', 1)[0] for line in f.read().split('\n')[1:] if line]
+    lexicon = [w for w in lexicon if w.isalpha() and w.islower()]
+    rng.shuffle(lexicon)
+    vocab = np.array(STOPWORDS + lexicon, dtype=object)
+    p = 1 / (np.arange(len(vocab)) + 2.7)
+    p /= p.sum()
+
+    texts = []
+    for _ in range(n_docs):
+        out = []
+        for _ in range(rng.integers(*sentences)):
+            sentence = list(rng.choice(vocab, rng.integers(*words), p=p))
+            if rng.random() < 0.2:
+                sentence.insert(rng.integers(len(sentence)), str(rng.integers(1, 2030)))
+            if rng.random() < 0.1:
+                sentence.insert(rng.integers(len(sentence)), "n't" if rng.random() < 0.5 else "not")
+            if rng.random() < 0.3:
+                sentence[rng.integers(len(sentence))] += ','
+            if rng.random() < 0.02:
+                sentence.append(f"https://www.news{rng.integers(100)}.com/story")
+            out.append(' '.join(sentence).capitalize() + '.')
+        texts.append(' '.join(out).replace(" n't", "n't"))
+    return texts
+
+
+# Each stage function takes (texts, workdir, options) and returns (number of
+# items, function to time); imports happen here, outside of the timing.
+
+def stage_clean_text(texts, workdir, options):
+    from word2vec_main import clean_text
+    return len(texts), lambda: [clean_text(t) for t in texts]
+
+
+def stage_clean_text_fast(texts, workdir, options):
+    from word2vec_main import clean_text_fast
+    return len(texts), lambda: [clean_text_fast(t) for t in texts]
+
+
+def _halves(texts):
+    return texts[:len(texts) // 2], texts[len(texts) // 2:]
+
+
+def stage_log_odds(texts, workdir, options):
+    import log_odds_ratio
+    corpus_i, corpus_j = _halves(texts)
+    return len(texts), lambda: log_odds_ratio.main(corpus_i, corpus_j, engine="python")
+
+
+def stage_log_odds_numpy(texts, workdir, options):
+    import log_odds_ratio
+    corpus_i, corpus_j = _halves(texts)
+    return len(texts), lambda: log_odds_ratio.main(corpus_i, corpus_j, engine="numpy")
+
+
+def _make_models(texts, workdir, n_queries, n_models=3, dim=50, max_words=5000):
+    # random vectors for the most frequent corpus words, saved as .wv files
+    from collections import Counter
+    from gensim.models import KeyedVectors
+
+    counts = Counter(w for t in texts for w in t.lower().split() if w.isalpha())
+    words = [w for w, _ in counts.most_common(max_words)]
+    word2vec_dir = os.path.join(workdir, "wv")
+    os.makedirs(word2vec_dir, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for k in range(n_models):
+        kv = KeyedVectors(dim)
+        kv.add_vectors(words, rng.standard_normal((len(words), dim)).astype(np.float32))
+        kv.save(os.path.join(word2vec_dir, f"{k}.wv"))
+    queries = [[words[i], words[i + 1]] for i in range(0, 2 * n_queries, 2)]
+    return word2vec_dir, words, queries
+
+
+def stage_get_closest(texts, workdir, options):
+    import word2vec_get_closest
+    word2vec_dir, words, queries = _make_models(texts, workdir, options["n_queries"])
+    models = word2vec_get_closest.get_models(word2vec_get_closest.find_model_files(word2vec_dir))
+    return len(queries), lambda: [word2vec_get_closest.get_closest(q, models, words, words) for q in queries]
+
+
+def stage_ensemble_index(texts, workdir, options):
+    import word2vec_get_closest
+    word2vec_dir, words, queries = _make_models(texts, workdir, options["n_queries"])
+    index = word2vec_get_closest.EnsembleIndex.load_or_build(word2vec_dir)
+    return len(queries), lambda: index.query(queries, 15)
+
+
+def stage_vad(texts, workdir, options):
+    sys.path.insert(0, os.path.join(ROOT, "VAD"))
+    import anew_vad_analysis
+    # load the lexicon and NLTK resources before timing
+    anew_vad_analysis.analyze_text(texts[0])
+    return len(texts), lambda: [anew_vad_analysis.analyze_text(t) for t in texts]
+
+
+def stage_vad_pool(texts, workdir, options):
+    sys.path.insert(0, os.path.join(ROOT, "VAD"))
+    import anew_vad_analysis
+    anew_vad_analysis.analyze_text(texts[0])
+    return len(texts), lambda: anew_vad_analysis.analyze_texts(texts, n_jobs=options["n_jobs"])
+
+
+class StubClassifier:
+    """
+    Stand-in for the zero-shot pipeline: same call signature and output
+    format, with scores from a cheap hash of the text.
+    """
+
+    def __call__(self, texts, labels, batch_size=8, truncation=True):
+        for text in texts:
+            scores = np.random.default_rng(len(text)).random(len(labels))
+            order = np.argsort(-scores)
+            yield {"sequence": text, "labels": [labels[k] for k in order], "scores": scores[order].tolist()}
+
+
+def stage_zero_shot(texts, workdir, options):
+    import pandas as pd
+    import run_zero_shot_classification as zsc
+    if options["zsc_model"]:
+        classifier = zsc.load_classifier(options["zsc_model"], device=-1)
+    else:
+        classifier = StubClassifier()
+    df = pd.DataFrame({"Article Text": texts})
+    return len(texts), lambda: zsc.f_zero_shot_classification(df, zsc.topic_labels, classifier=classifier)
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    """
+    Chat completions endpoint answering every request with a rating of 0.5
+    for every label, after `latency` seconds.
+    """
+
+    latency = 0.0
+    content = "{}"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        body = json.dumps({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "mock",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_server(labels, latency=0.0):
+    """Serve `MockChatHandler` on a free local port; returns the server."""
+    handler = type("Handler", (MockChatHandler,), {
+        "latency": latency,
+        "content": json.dumps({label: 0.5 for label in labels}),
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stage_gpt(texts, workdir, options):
+    import gpt_helper
+    labels = (gpt_helper.topic_labels, gpt_helper.sentiment_labels)
+    server = start_mock_server(labels[0] + labels[1], options["mock_latency"])
+    gpt_helper.API_KEY = "mock"
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    # distinct prompts, so none are deduplicated
+    texts = [f"{i}. {t}" for i, t in enumerate(texts)]
+    return len(texts), lambda: gpt_helper.analyze_many(
+        texts, labels, base_url=base_url, rpm=10 ** 9, tpm=10 ** 12, concurrency=options["concurrency"]
+    )
+
+
+STAGES = {
+    "clean_text": stage_clean_text,
+    "clean_text_fast": stage_clean_text_fast,
+    "log_odds": stage_log_odds,
+    "log_odds_numpy": stage_log_odds_numpy,
+    "get_closest": stage_get_closest,
+    "ensemble_index": stage_ensemble_index,
+    "vad": stage_vad,
+    "vad_pool": stage_vad_pool,
+    "zero_shot": stage_zero_shot,
+    "gpt": stage_gpt,
+}
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def run_stage(stage, scale, seed, repeat, options):
+    """Run one stage at one scale (in the current process); returns a result dict."""
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    result = {"stage": stage, "scale": scale}
+    try:
+        texts = make_corpus(scale, seed)
+        with tempfile.TemporaryDirectory() as workdir:
+            n_items, run = STAGES[stage](texts, workdir, options)
+            setup_rss = _peak_rss_mb()
+            seconds = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                seconds.append(time.perf_counter() - start)
+    except Exception as e:
+        # first 200 characters, on one line
+        result.update(status="error", error=f"{type(e).__name__}: {' '.join(str(e).split())[:200]}")
+        return result
+
+    best = min(seconds)
+    result.update(
+        status="ok",
+        n_items=n_items,
+        seconds=best,
+        all_seconds=seconds,
+        items_per_sec=n_items / best if best > 0 else float("inf"),
+        setup_rss_mb=setup_rss,
+        peak_rss_mb=_peak_rss_mb(),
+    )
+    return result
+
+
+def scaling(results):
+    """
+    Per stage, the throughput at each scale and the exponent b of the fit
+    seconds ~ n_items ** b (1: linear).
+    """
+    curves = {}
+    for stage in dict.fromkeys(r["stage"] for r in results):
+        points = [r for r in results if r["stage"] == stage and r["status"] == "ok"]
+        curve = {
+            "scales": [r["scale"] for r in points],
+            "items_per_sec": [r["items_per_sec"] for r in points],
+            "peak_rss_mb": [r["peak_rss_mb"] for r in points],
+            "exponent": None,
+        }
+        if len({r["n_items"] for r in points}) > 1 and all(r["seconds"] > 0 for r in points):
+            curve["exponent"] = float(np.polyfit(
+                np.log([r["n_items"] for r in points]), np.log([r["seconds"] for r in points]), 1
+            )[0])
+        curves[stage] = curve
+    return curves
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Throughput ratio (current / baseline) of every (stage, scale) found in
+    both; "regression" below 1 - `tolerance`, "improvement" above
+    1 + `tolerance`.
+    """
+    previous = {(r["stage"], r["scale"]): r for r in baseline["results"] if r["status"] == "ok"}
+    comparisons = []
+    for r in results:
+        old = previous.get((r["stage"], r["scale"]))
+        if r["status"] != "ok" or old is None:
+            continue
+        ratio = r["items_per_sec"] / old["items_per_sec"]
+        verdict = "regression" if ratio < 1 - tolerance else "improvement" if ratio > 1 + tolerance else "unchanged"
+        comparisons.append({
+            "stage": r["stage"],
+            "scale": r["scale"],
+            "items_per_sec": r["items_per_sec"],
+            "baseline_items_per_sec": old["items_per_sec"],
+            "ratio": ratio,
+            "peak_rss_mb": r["peak_rss_mb"],
+            "baseline_peak_rss_mb": old["peak_rss_mb"],
+            "verdict": verdict,
+        })
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated stages")
+    parser.add_argument("--scales", default="100,1000,10000", help="comma-separated corpus sizes (articles)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage and scale; the best counts")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="earlier --output file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--n-jobs", type=int, default=os.cpu_count(), help="processes for vad_pool")
+    parser.add_argument("--n-queries", type=int, default=20, help="query sets for get_closest / ensemble_index")
+    parser.add_argument("--zsc-model", help="Hugging Face model for zero_shot instead of the stub")
+    parser.add_argument("--mock-latency", type=float, default=0.05, help="seconds per mock GPT request")
+    parser.add_argument("--concurrency", type=int, default=16, help="GPT requests in flight")
+    args = parser.parse_args()
+
+    stages = args.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage!r}; choose from {', '.join(STAGES)}")
+    scales = [int(s) for s in args.scales.split(",")]
+    options = {
+        "n_jobs": args.n_jobs,
+        "n_queries": args.n_queries,
+        "zsc_model": args.zsc_model,
+        "mock_latency": args.mock_latency,
+        "concurrency": args.concurrency,
+    }
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for stage in stages:
+        for scale in scales:
+            # fresh process per run, so peak RSS and caches are per stage
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                r = pool.submit(run_stage, stage, scale, args.seed, args.repeat, options).result()
+            results.append(r)
+            if r["status"] == "ok":
+                print(f"{stage:>16} {scale:>8}: {r['items_per_sec']:12.1f} items/s "
+                      f"{r['seconds']:9.3f} s {r['peak_rss_mb']:9.1f} MB")
+            else:
+                print(f"{stage:>16} {scale:>8}: {r['error']}")
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "options": options,
+        },
+        "results": results,
+        "scaling": scaling(results),
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            report["comparison"] = compare(results, json.load(f), args.tolerance)
+        for c in report["comparison"]:
+            print(f"{c['stage']:>16} {c['scale']:>8}: {c['ratio']:6.2f}x baseline ({c['verdict']})")
+        regressions = [c for c in report["comparison"] if c["verdict"] == "regression"]
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+# makes the top-level modules importable from tests/
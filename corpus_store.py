@@ -0,0 +1,343 @@
+"""
+Tokenize-once corpus store shared by the analysis modules.
+
+Every article is preprocessed once per view and stored under the SHA-256 of
+its text, so adding a dataset again only processes articles that are new.
+Each view is a directory holding
+
+    manifest.json       committed sizes (articles, sentences, tokens, words, tags)
+    docs.sha256         article hashes, 32 bytes each
+    doc_offsets.int64   first sentence of each article, plus the end
+    sent_offsets.int64  first token of each sentence, plus the end
+    tokens.int32        token ids
+    words.txt           id -> token, one per line
+    tags.uint8          POS tag id of each token ("tagged" view only)
+    tagset.txt          id -> POS tag ("tagged" view only)
+
+The arrays are appended to in place and memory-mapped when read. The manifest
+is replaced last, so an interrupted update leaves the previous state
+readable; its partial data is truncated by the next update.
+
+Views:
+    clean:  sentences as in `word2vec_main` (`nltk.sent_tokenize`, then
+            `clean_text_fast`)
+    words:  whitespace tokens, one sentence per article, as in `log_odds_ratio`
+    tagged: lower-cased `nltk.word_tokenize` tokens of each sentence with
+            their Penn Treebank tags, as in `VAD/anew_vad_analysis`
+"""
+
+
+import os
+import json
+import array
+import hashlib
+import functools
+import multiprocessing
+import numpy as np
+from scipy import sparse
+
+import metrics
+
+
+def _clean_documents(texts):
+    import nltk
+    from word2vec_main import clean_text_fast
+    return [[clean_text_fast(s) for s in nltk.sent_tokenize(text)] for text in texts]
+
+
+def _split_documents(texts):
+    return [[text.split()] for text in texts]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tagger():
+    from nltk.tag import PerceptronTagger
+    return PerceptronTagger()
+
+
+def _tag_documents(texts):
+    # the sentences of the whole chunk are tagged as one batch
+    import nltk
+    documents = [[nltk.word_tokenize(s.lower()) for s in nltk.sent_tokenize(text)] for text in texts]
+    tagged = iter(_get_tagger().tag_sents([sentence for document in documents for sentence in document]))
+    return [[next(tagged) for _ in document] for document in documents]
+
+
+# view name -> (function from a list of texts to their documents, tagged)
+VIEWS = {
+    "clean": (_clean_documents, False),
+    "words": (_split_documents, False),
+    "tagged": (_tag_documents, True),
+}
+
+
+def content_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _chunks(items, chunksize):
+    for start in range(0, len(items), chunksize):
+        yield items[start:start + chunksize]
+
+
+def _ranges(starts, ends):
+    # concatenation of range(s, e) for each (s, e), as one array
+    lengths = ends - starts
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(lengths.sum(), dtype=np.int64) + offsets
+
+
+class Sentences:
+    """
+    Restartable iterable over selected sentences of a view (token lists, or
+    (token, tag) lists for the tagged view), e.g. for `Word2Vec`.
+    """
+
+    def __init__(self, view, indices):
+        self.view = view
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        sentence = self.view.sentence
+        for i in self.indices.tolist():
+            yield sentence(i)
+
+
+class CorpusView:
+    """
+    One view of the store (see module docstring); read with `documents`,
+    `sentences` or `document_term_matrix`, each taking a list of article
+    keys (as returned by `CorpusStore.add`) or None for every article.
+    """
+
+    def __init__(self, path, tagged=False):
+        self.path = path
+        self.tagged = tagged
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _map(self, name, dtype, count):
+        # np.memmap can't map an empty file
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode='r', shape=(count,))
+
+    def _load(self):
+        if os.path.exists(self._file("manifest.json")):
+            with open(self._file("manifest.json"), 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"n_docs": 0, "n_sentences": 0, "n_tokens": 0, "n_words": 0, "n_tags": 0}
+        m = self.manifest
+
+        self.keys = []
+        if m["n_docs"]:
+            with open(self._file("docs.sha256"), 'rb') as f:
+                data = f.read(32 * m["n_docs"])
+            self.keys = [data[i:i + 32].hex() for i in range(0, len(data), 32)]
+        self.key2id = {key: i for i, key in enumerate(self.keys)}
+
+        self.doc_offsets = self._map("doc_offsets.int64", np.int64, m["n_docs"] + 1) \
+            if m["n_docs"] else np.zeros(1, dtype=np.int64)
+        self.sent_offsets = self._map("sent_offsets.int64", np.int64, m["n_sentences"] + 1) \
+            if m["n_sentences"] else np.zeros(1, dtype=np.int64)
+        self.tokens = self._map("tokens.int32", np.int32, m["n_tokens"])
+        self.words = self._read_lines("words.txt", m["n_words"])
+        if self.tagged:
+            self.tags = self._map("tags.uint8", np.uint8, m["n_tokens"])
+            self.tagset = self._read_lines("tagset.txt", m["n_tags"])
+
+    def _read_lines(self, name, count):
+        if count == 0:
+            return []
+        # tokens never contain newlines
+        with open(self._file(name), 'r', encoding='utf-8') as f:
+            return f.read().split('\n')[:count]
+
+    def _write_lines(self, name, lines):
+        with open(self._file(name) + ".tmp", 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+        os.replace(self._file(name) + ".tmp", self._file(name))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key2id
+
+    def doc_ids(self, keys=None):
+        if keys is None:
+            return np.arange(len(self.keys), dtype=np.int64)
+        return np.fromiter((self.key2id[key] for key in keys), dtype=np.int64, count=len(keys))
+
+    def sentence(self, i):
+        start, end = self.sent_offsets[i], self.sent_offsets[i + 1]
+        words = self.words
+        if self.tagged:
+            tagset = self.tagset
+            return [(words[w], tagset[t]) for w, t in zip(self.tokens[start:end].tolist(), self.tags[start:end].tolist())]
+        return [words[w] for w in self.tokens[start:end].tolist()]
+
+    def documents(self, keys=None):
+        """Yield the sentences of each article."""
+        for i in self.doc_ids(keys).tolist():
+            yield [self.sentence(s) for s in range(self.doc_offsets[i], self.doc_offsets[i + 1])]
+
+    def sentences(self, keys=None):
+        """All sentences of the articles, in order, as a restartable iterable."""
+        doc_ids = self.doc_ids(keys)
+        return Sentences(self, _ranges(self.doc_offsets[doc_ids], self.doc_offsets[doc_ids + 1]))
+
+    def document_term_matrix(self, keys=None):
+        """
+        Sparse (n_articles, n_words) token count matrix and the word list,
+        like `log_odds_ratio.document_term_matrix` (columns are in order of
+        first appearance in the store, not in the selected articles).
+        """
+        doc_ids = self.doc_ids(keys)
+        starts = np.asarray(self.sent_offsets)[np.asarray(self.doc_offsets)[doc_ids]]
+        ends = np.asarray(self.sent_offsets)[np.asarray(self.doc_offsets)[doc_ids + 1]]
+        rows = np.repeat(np.arange(len(doc_ids), dtype=np.int64), ends - starts)
+        columns = np.asarray(self.tokens)[_ranges(starts, ends)]
+        X = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int64), (rows, columns)),
+            shape=(len(doc_ids), len(self.words))
+        )
+        return X, list(self.words)
+
+    def extend(self, keys, documents, buffer_size=1 << 20):
+        """
+        Append `documents` (sentences of token lists, or of (token, tag)
+        lists for the tagged view) under `keys`, `buffer_size` tokens at a
+        time, and commit.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        m = dict(self.manifest)
+        # committed bytes of each file (offsets: without the leading 0)
+        sizes = {
+            "docs.sha256": 32 * m["n_docs"],
+            "doc_offsets.int64": 8 * m["n_docs"],
+            "sent_offsets.int64": 8 * m["n_sentences"],
+            "tokens.int32": 4 * m["n_tokens"],
+        }
+        if self.tagged:
+            sizes["tags.uint8"] = m["n_tokens"]
+
+        files = {}
+        for name, size in sizes.items():
+            files[name] = f = open(self._file(name), 'ab+')
+            if name.endswith("offsets.int64"):
+                if size == 0:
+                    f.truncate(0)
+                    array.array('q', [0]).tofile(f)
+                size += 8
+            # drop whatever an interrupted update left behind the committed data
+            f.truncate(size)
+
+        words = list(self.words)
+        word2id = {w: i for i, w in enumerate(words)}
+        if self.tagged:
+            tagset = list(self.tagset)
+            tag2id = {t: i for i, t in enumerate(tagset)}
+
+        digests = bytearray()
+        doc_offsets, sent_offsets = array.array('q'), array.array('q')
+        tokens, tags = array.array('i'), array.array('B')
+
+        def flush():
+            files["docs.sha256"].write(digests)
+            doc_offsets.tofile(files["doc_offsets.int64"])
+            sent_offsets.tofile(files["sent_offsets.int64"])
+            tokens.tofile(files["tokens.int32"])
+            if self.tagged:
+                tags.tofile(files["tags.uint8"])
+            del digests[:], doc_offsets[:], sent_offsets[:], tokens[:], tags[:]
+
+        try:
+            for key, sentences in zip(keys, documents):
+                for sentence in sentences:
+                    if self.tagged:
+                        for w, t in sentence:
+                            tokens.append(word2id.setdefault(w, len(word2id)))
+                            tags.append(tag2id.setdefault(t, len(tag2id)))
+                    else:
+                        for w in sentence:
+                            tokens.append(word2id.setdefault(w, len(word2id)))
+                    m["n_tokens"] += len(sentence)
+                    m["n_sentences"] += 1
+                    sent_offsets.append(m["n_tokens"])
+                digests += bytes.fromhex(key)
+                m["n_docs"] += 1
+                doc_offsets.append(m["n_sentences"])
+                if len(tokens) >= buffer_size:
+                    flush()
+            flush()
+            for f in files.values():
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            for f in files.values():
+                f.close()
+
+        words.extend(w for w in list(word2id)[len(words):])
+        m["n_words"] = len(words)
+        self._write_lines("words.txt", words)
+        if self.tagged:
+            tagset.extend(t for t in list(tag2id)[len(tagset):])
+            m["n_tags"] = len(tagset)
+            self._write_lines("tagset.txt", tagset)
+
+        with open(self._file("manifest.json") + ".tmp", 'w') as f:
+            json.dump(m, f, indent=2)
+        os.replace(self._file("manifest.json") + ".tmp", self._file("manifest.json"))
+        self._load()
+
+
+class CorpusStore:
+    """
+    Directory of views over the same articles.
+
+    Args:
+        path:
+            Store directory, e.g. "data/corpus"
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def view(self, name):
+        return CorpusView(os.path.join(self.path, name), tagged=VIEWS[name][1])
+
+    def add(self, texts, views=tuple(VIEWS), n_jobs=1, chunksize=64):
+        """
+        Preprocess the articles of `texts` that are not in the store yet for
+        each of `views`, spreading chunks of `chunksize` articles over
+        `n_jobs` processes (None: all CPUs).
+
+        Returns the key of each text, in order.
+        """
+        texts = [str(text) for text in texts]
+        keys = [content_key(text) for text in texts]
+        n_jobs = n_jobs or os.cpu_count()
+
+        for name in views:
+            view = self.view(name)
+            new = {key: text for key, text in zip(keys, texts) if key not in view}
+            if not new:
+                continue
+            print(f"Corpus store: preprocessing {len(new)} new articles for '{name}'")
+            metrics.count("corpus_store.articles." + name, len(new))
+            preprocess = VIEWS[name][0]
+            chunks = _chunks(list(new.values()), chunksize)
+            with metrics.timer("corpus_store.preprocess." + name):
+                if n_jobs == 1:
+                    view.extend(new, (d for chunk in map(preprocess, chunks) for d in chunk))
+                else:
+                    with multiprocessing.Pool(n_jobs) as pool:
+                        view.extend(new, (d for chunk in pool.imap(preprocess, chunks) for d in chunk))
+        return keys
@@ -0,0 +1,341 @@
+"""
+Offline Batch-API mode for GPT labeling (see `gpt_helper`).
+
+The corpus is written as batch request JSONL files (one request per unique
+rendered prompt; custom_id is a hash of the prompt), submitted, polled until
+done, and the results are validated with `gpt_helper.check` and merged back
+into the dataset as "GPT-<label>" columns.
+
+Submission and polling go through a transport object with three methods:
+    submit(requests_filename) -> job id
+    status(job_id) -> "validating", "in_progress", ..., "completed", "failed", ...
+    download(job_id, out_filename) -> writes the output JSONL
+`OpenAIBatchTransport` talks to the OpenAI Batch API; `LocalBatchTransport`
+answers requests locally with a user-supplied function, for tests and dry runs.
+"""
+
+
+import os
+import json
+import time
+import hashlib
+import openai
+import pandas as pd
+
+import metrics
+import gpt_helper
+from gpt_helper import topic_labels, sentiment_labels
+
+
+ENDPOINT = "/v1/chat/completions"
+DONE_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class OpenAIBatchTransport:
+    """Transport backed by the OpenAI Batch API."""
+
+    def __init__(self, client=None, completion_window="24h"):
+        self.client = client if client is not None else openai.OpenAI(api_key=gpt_helper.API_KEY)
+        self.completion_window = completion_window
+
+    def submit(self, requests_filename):
+        with open(requests_filename, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=ENDPOINT,
+            completion_window=self.completion_window
+        )
+        return batch.id
+
+    def status(self, job_id):
+        return self.client.batches.retrieve(job_id).status
+
+    def download(self, job_id, out_filename):
+        batch = self.client.batches.retrieve(job_id)
+        with open(out_filename, 'w', encoding='utf-8') as f:
+            # failed requests are reported in the error file, same line format
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    f.write(self.client.files.content(file_id).text.rstrip('\n') + '\n')
+
+
+class LocalBatchTransport:
+    """
+    Local stand-in for the Batch API.
+
+    Args:
+        respond:
+            Function taking a request body (dict with "model", "messages", ...)
+            and returning the assistant message content (a JSON string)
+        polls_until_done (default = 1):
+            Number of `status()` calls that report "in_progress" before the
+            job completes
+    """
+
+    def __init__(self, respond, polls_until_done=1):
+        self.respond = respond
+        self.polls_until_done = polls_until_done
+        self.jobs = {}
+
+    def submit(self, requests_filename):
+        job_id = f"batch_local_{len(self.jobs)}"
+        self.jobs[job_id] = {"requests": requests_filename, "polls": 0}
+        return job_id
+
+    def status(self, job_id):
+        job = self.jobs[job_id]
+        job["polls"] += 1
+        return "completed" if job["polls"] > self.polls_until_done else "in_progress"
+
+    def download(self, job_id, out_filename):
+        with open(self.jobs[job_id]["requests"], 'r', encoding='utf-8') as f_in, \
+                open(out_filename, 'w', encoding='utf-8') as f_out:
+            for line in f_in:
+                request = json.loads(line)
+                content = self.respond(request["body"])
+                f_out.write(json.dumps({
+                    "id": "req_" + request["custom_id"],
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {"choices": [{"message": {"role": "assistant", "content": content}}]},
+                    },
+                    "error": None,
+                }) + '\n')
+
+
+def make_custom_id(prompt):
+    return "prompt-" + hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:32]
+
+
+def write_batch_requests(
+        prompts,
+        requests_dir,
+        model=gpt_helper.MODEL,
+        system_content=gpt_helper.SYSTEM_CONTENT,
+        temperature=gpt_helper.TEMPERATURE,
+        max_requests=50000,
+        first_index=0
+    ):
+    """
+    Write one request per unique prompt into batch request JSONL files of at
+    most `max_requests` lines (the Batch API per-file limit), numbered from
+    `first_index`.
+
+    Returns the list of request filenames.
+    """
+    os.makedirs(requests_dir, exist_ok=True)
+    filenames = []
+    f = None
+    for n, prompt in enumerate(dict.fromkeys(prompts)):
+        if n % max_requests == 0:
+            if f is not None:
+                f.close()
+            filenames.append(os.path.join(requests_dir, f"requests-{first_index + len(filenames):03d}.jsonl"))
+            f = open(filenames[-1], 'w', encoding='utf-8')
+        f.write(json.dumps({
+            "custom_id": make_custom_id(prompt),
+            "method": "POST",
+            "url": ENDPOINT,
+            "body": {
+                "model": model,
+                "response_format": {"type": "json_object"},
+                "messages": [
+                    {"role": "system", "content": system_content},
+                    {"role": "user", "content": prompt}
+                ],
+                "temperature": temperature,
+            },
+        }, ensure_ascii=False) + '\n')
+    if f is not None:
+        f.close()
+    return filenames
+
+
+def read_request_ids(requests_filename):
+    """Return the custom_ids of a batch request file, in order."""
+    with open(requests_filename, 'r', encoding='utf-8') as f:
+        return [json.loads(line)["custom_id"] for line in f if line.strip()]
+
+
+def read_jobs(jobs_filename):
+    """
+    Return the submitted jobs recorded in `jobs_filename`, a list of 
+    {"requests": filename, "job_id": ..., "custom_ids": [...]}, plus 
+    "status" once the job ended; empty if the file doesn't exist.
+    """
+    if not os.path.exists(jobs_filename):
+        return []
+    with open(jobs_filename, 'r') as f:
+        jobs = json.load(f)
+    if isinstance(jobs, dict):
+        # older format: {requests filename: job id}
+        jobs = [
+            {"requests": requests_filename, "job_id": job_id, "custom_ids": read_request_ids(requests_filename)}
+            for requests_filename, job_id in jobs.items()
+        ]
+    return jobs
+
+
+def write_jobs(jobs_filename, jobs):
+    # replaced atomically, so that a crash leaves the previous list readable
+    with open(jobs_filename + ".tmp", 'w') as f:
+        json.dump(jobs, f, indent=2)
+    os.replace(jobs_filename + ".tmp", jobs_filename)
+
+
+def read_batch_results(out_filename):
+    """Return {custom_id: parsed JSON response or None} from a batch output file."""
+    results = {}
+    with open(out_filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+                results[record["custom_id"]] = json.loads(content)
+            except (KeyError, IndexError, TypeError, json.decoder.JSONDecodeError):
+                results[record["custom_id"]] = None
+    return results
+
+
+def wait_for_batch(transport, job_id, poll_interval=60, timeout=None):
+    """Poll `job_id` until it reaches a final status; returns that status."""
+    start = time.monotonic()
+    while True:
+        status = transport.status(job_id)
+        metrics.count("gpt_batch.polls")
+        if status in DONE_STATUSES:
+            return status
+        if timeout is not None and time.monotonic() - start > timeout:
+            raise TimeoutError(f"batch {job_id} still {status} after {timeout}s")
+        print(f"Batch {job_id}: {status}")
+        time.sleep(poll_interval)
+
+
+def column_name(label):
+    # df column for a GPT label, mirroring the "ZSC-" columns
+    return "GPT-" + label.replace(" ", "-")
+
+
+def run_batch(
+        df,
+        transport,
+        workdir,
+        labels=(topic_labels, sentiment_labels),
+        prompt_filename="gpt-prompt-combined",
+        text_column="Article Text",
+        out_filename=None,
+        poll_interval=60,
+        cache=None,
+        max_requests=50000
+    ):
+    """
+    Label the "Article Text" column of `df` through the Batch API.
+
+    df: dataframe or CSV filename
+    transport: `OpenAIBatchTransport`, `LocalBatchTransport` or compatible
+    workdir: directory for request/output files and the job list 
+        "jobs.json". Each job is recorded with its request ids as soon as it
+        is submitted, and with its status once it ends; when the function is
+        rerun, recorded jobs are polled again, and only prompts that no 
+        pending or completed job holds (e.g. rows added to `df`, files not
+        submitted before a crash, or requests of an expired job) are 
+        submitted
+    cache: optional `gpt_cache.ResponseCache`; cached prompts are not
+        submitted, and new valid results are stored
+    max_requests: requests per batch file
+
+    Adds one "GPT-<label>" column per label (NaN where the response is
+    missing or fails `check()`) and a boolean "GPT-valid" column. If
+    provided, saves the result to `out_filename`.
+    """
+    if type(df) is str:
+        df = pd.read_csv(df)
+    os.makedirs(workdir, exist_ok=True)
+    model, system_content, temperature = gpt_helper.MODEL, gpt_helper.SYSTEM_CONTENT, gpt_helper.TEMPERATURE
+
+    template = gpt_helper.get_template(prompt_filename, labels)
+    prompts = [template.render(str(text)) for text in df[text_column]]
+    custom_ids = [make_custom_id(prompt) for prompt in prompts]
+
+    results = {}
+    if cache is not None:
+        for prompt, custom_id in zip(prompts, custom_ids):
+            response = cache.get(model, system_content, temperature, prompt)
+            if response is not None:
+                results[custom_id] = response
+    to_submit = [p for p, c in zip(prompts, custom_ids) if c not in results]
+
+    jobs_filename = os.path.join(workdir, "jobs.json")
+    jobs = read_jobs(jobs_filename)
+    # requests of jobs that ended without completing (expired, failed, 
+    # cancelled) are submitted again
+    live_jobs = [job for job in jobs if job.get("status", "completed") == "completed"]
+    submitted_ids = {custom_id for job in live_jobs for custom_id in job["custom_ids"]}
+    new = [p for p in to_submit if make_custom_id(p) not in submitted_ids]
+    if new:
+        if jobs:
+            print(f"Submitting {len(set(new))} requests not in {jobs_filename}")
+        # numbered after the recorded files; files of an interrupted run 
+        # that were never submitted are overwritten
+        for requests_filename in write_batch_requests(
+                new, os.path.join(workdir, "requests"), model, system_content, temperature,
+                max_requests, first_index=len(jobs)):
+            job_id = transport.submit(requests_filename)
+            jobs.append({
+                "requests": requests_filename, "job_id": job_id, "custom_ids": read_request_ids(requests_filename)
+            })
+            write_jobs(jobs_filename, jobs)
+
+    needed = set(custom_ids) - results.keys()
+    for job in jobs:
+        if job.get("status", "completed") != "completed" or needed.isdisjoint(job["custom_ids"]):
+            continue
+        job_id = job["job_id"]
+        output_filename = os.path.join(workdir, f"output-{job_id}.jsonl")
+        if job.get("status") == "completed" and os.path.exists(output_filename):
+            results.update(read_batch_results(output_filename))
+            continue
+        status = wait_for_batch(transport, job_id, poll_interval)
+        if job.get("status") != status:
+            job["status"] = status
+            write_jobs(jobs_filename, jobs)
+        if status != "completed":
+            # its partial output is used, but not kept: the next run 
+            # submits its requests again
+            print(f"Batch {job_id} ended with status {status}; its requests are submitted again on the next run")
+            output_filename += ".partial"
+        if status != "completed" or not os.path.exists(output_filename):
+            with metrics.timer("gpt_batch.download"):
+                transport.download(job_id, output_filename)
+        results.update(read_batch_results(output_filename))
+        if status != "completed":
+            os.remove(output_filename)
+
+    flat_labels = labels[0] + labels[1] if type(labels) is tuple else list(labels)
+    submitted = set(to_submit)
+    valid = []
+    columns = {label: [] for label in flat_labels}
+    for prompt, custom_id in zip(prompts, custom_ids):
+        response = results.get(custom_id)
+        ok = gpt_helper.is_valid(response, labels)
+        if ok and cache is not None and prompt in submitted:
+            cache.put(model, system_content, temperature, prompt, response)
+            submitted.discard(prompt)
+        valid.append(ok)
+        for label in flat_labels:
+            columns[label].append(response[label] if ok else float("nan"))
+
+    for label in flat_labels:
+        df[column_name(label)] = columns[label]
+    df["GPT-valid"] = valid
+    print(f"{sum(valid)} / {len(valid)} rows with valid results")
+
+    if out_filename is not None:
+        df.to_csv(out_filename, index=False)
+
+    return df
@@ -0,0 +1,135 @@
+"""
+On-disk, content-addressed cache for GPT responses (see `gpt_helper`).
+
+Entries are keyed by a hash of (model, system_content, temperature, prompt),
+where prompt is the fully rendered prompt, so any change to the article, the
+labels or the prompt template is a new key.
+"""
+
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+import metrics
+
+
+class CacheMiss(KeyError):
+    """Raised on a miss when the cache is read-only and `strict`."""
+
+
+def make_key(model, system_content, temperature, prompt):
+    payload = json.dumps([model, system_content, temperature, prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed response cache.
+
+    Args:
+        path:
+            SQLite file, e.g. "data/gpt-cache.sqlite"
+        max_age (default = None):
+            Seconds after which an entry is stale; stale entries are treated
+            as misses and removed by `evict()`
+        max_entries (default = None):
+            If set, `evict()` keeps only the `max_entries` most recently used
+            entries
+        readonly (default = False):
+            Never write; for reproducible reruns against a frozen cache
+        strict (default = False):
+            With `readonly`, raise `CacheMiss` instead of returning None so
+            that a rerun can't silently fall back to the API
+    """
+
+    def __init__(self, path, max_age=None, max_entries=None, readonly=False, strict=False):
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.readonly = readonly
+        self.strict = strict
+        self.hits = 0
+        self.misses = 0
+
+        if readonly:
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON responses(accessed)")
+            self.conn.commit()
+            self.evict()
+
+    def get(self, model, system_content, temperature, prompt):
+        """Return the cached (parsed) response, or None on a miss."""
+        key = make_key(model, system_content, temperature, prompt)
+        row = self.conn.execute(
+            "SELECT response, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None and self.max_age is not None and time.time() - row[1] > self.max_age:
+            row = None
+
+        if row is None:
+            self.misses += 1
+            metrics.count("gpt_cache.misses")
+            if self.readonly and self.strict:
+                raise CacheMiss(key)
+            return None
+
+        self.hits += 1
+        metrics.count("gpt_cache.hits")
+        if not self.readonly:
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, model, system_content, temperature, prompt, response):
+        if self.readonly:
+            return
+        key = make_key(model, system_content, temperature, prompt)
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(response), now, now)
+        )
+        self.conn.commit()
+
+    def evict(self):
+        """Drop stale entries and, if needed, the least recently used ones."""
+        if self.readonly:
+            return
+        if self.max_age is not None:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+        if self.max_entries is not None:
+            self.conn.execute(
+                "DELETE FROM responses WHERE key NOT IN "
+                "(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+        self.conn.commit()
+
+    def stats(self):
+        n = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "entries": n,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -2,14 +2,23 @@ import os
 import csv
 import json
 import time
+import random
+import asyncio
 import nltk
 import openai
 import pandas as pd
 from collections import Counter
 
+import metrics
+
 
 API_KEY = ""
 
+# API parameters
+MODEL = 'gpt-4o'
+SYSTEM_CONTENT = 'You are a knowledgeable and unbiased judge.'
+TEMPERATURE = 0
+
 topic_labels = [
     "Education Policy", 
     "Personal Life", 
@@ -28,6 +37,65 @@ sentiment_labels = ["anger", "happiness", "frustration", "sadness", "disgust", "
 
 
 
+class PromptTemplate:
+    """
+    A prompt file compiled for one set of labels: the label lists are joined
+    and substituted once, and `render(text)` only inserts the article.
+
+    Packed templates (e.g. "gpt-prompt-combined-packed") contain 
+    [STATEMENTS] instead of [STATEMENT] and are rendered with 
+    `render_packed(texts)`, which puts several articles, each under its own 
+    key ("article_1", "article_2", ...), into one prompt.
+    """
+
+    def __init__(self, base_prompt, labels):
+        prompt = base_prompt
+        if type(labels) is tuple: 
+            # two label lists
+            if len(labels) != 2:
+                raise ValueError("check labels tuple len")
+            labels1, labels2 = labels
+            prompt = prompt.replace("[LABELS1]", ", ".join(labels1))
+            prompt = prompt.replace("[LABELS2]", ", ".join(labels2))
+        else:
+            # one label lists
+            prompt = prompt.replace("[LABELS]", ", ".join(labels))
+
+        self.packed = "[STATEMENTS]" in prompt
+        self.parts = prompt.split("[STATEMENTS]" if self.packed else "[STATEMENT]")
+
+    def render(self, text):
+        return text.join(self.parts)
+
+    def render_packed(self, texts):
+        articles = "\n\n".join(
+            f'{article_key(k)}:\n"""\n{text}\n"""' for k, text in enumerate(texts)
+        )
+        return articles.join(self.parts)
+
+
+def article_key(k):
+    # key of the k-th (0-based) article in a packed prompt and its response
+    return f"article_{k + 1}"
+
+
+_templates = {}
+
+def get_template(prompt_filename, labels):
+    """
+    Return the compiled `PromptTemplate` for `prompt_filename` and `labels`;
+    the file is read and compiled only once per process.
+    """
+    if type(labels) is tuple:
+        key = (prompt_filename, tuple(tuple(l) for l in labels))
+    else:
+        key = (prompt_filename, tuple(labels))
+    if key not in _templates:
+        with open(prompt_filename, 'r') as file:
+            _templates[key] = PromptTemplate(file.read(), labels)
+    return _templates[key]
+
+
 def __prepare_prompt(
         text, 
         labels=(topic_labels, sentiment_labels), 
@@ -41,72 +109,60 @@ def __prepare_prompt(
         sentiment labels as (topic_labels, sentiment_labels)
         - Otherwise, pass relevant labels only (there should be only one list). 
     """
+    return get_template(prompt_filename, labels).render(text)
 
-    with open(prompt_filename, 'r') as file:
-        base_prompt = file.read()
-
-    prompt = base_prompt.replace("[STATEMENT]", text)
 
-    if type(labels) is tuple: 
-        # two label lists
-        if len(labels) != 2:
-            raise "check labels tuple len"
-        labels1, labels2 = labels
-        prompt = prompt.replace("[LABELS1]", ", ".join(labels1))
-        prompt = prompt.replace("[LABELS2]", ", ".join(labels2))
-    else:
-        # one label lists
-        prompt = prompt.replace("[LABELS]", ", ".join(labels))
-    return prompt
+def __retry_sleep(error, seconds):
+    # count the retry by error type and time the wait
+    metrics.count("gpt.retries." + type(error).__name__)
+    with metrics.timer("gpt.retry_sleep"):
+        time.sleep(seconds)
 
 
 def __make_api_call(client, model, system_content, prompt, temperature):
     while True:
         #Make API call
         try:
-            chat_completion = client.chat.completions.create(
-                model=model,
-                response_format={"type": "json_object"},
-                messages=[
-                {"role": "system", "content": system_content},
-                {"role": "user", "content": prompt}
-                ],
-                temperature = temperature
-            )
+            with metrics.timer("gpt.request"):
+                chat_completion = client.chat.completions.create(
+                    model=model,
+                    response_format={"type": "json_object"},
+                    messages=[
+                    {"role": "system", "content": system_content},
+                    {"role": "user", "content": prompt}
+                    ],
+                    temperature = temperature
+                )
             response = chat_completion.choices[0].message.content
             #Verify clean output
             try:
                 response_clean = json.loads(response)
             except (json.decoder.JSONDecodeError) as e:
                 print(' Incorrect JSON format. Retrying...')
+                metrics.count("gpt.retries.JSONDecodeError")
                 continue    #retry API call if JSON parsing fails
             break  # Break out of the loop if API call is successful
-        except openai.error.APIError as e:
-            print(" API error. Retrying..."\
-                  "(if error persists, check status.openai.com)")
-            time.sleep(10)
-        except openai.error.Timeout as e:
-            print(" Request timed out. Retrying... "\
-                  "(if error persists, check internet connection)")
-            time.sleep(5)
-        except openai.error.RateLimitError as e:
+        except openai.RateLimitError as e:
             print(" Reached rate limit. Retrying... "\
                   "(if error persists, check number of tokens/requests)")
-            time.sleep(60)
-        except openai.error.APIConnectionError as e:
+            __retry_sleep(e, 60)
+        except openai.APITimeoutError as e:
+            print(" Request timed out. Retrying... "\
+                  "(if error persists, check internet connection)")
+            __retry_sleep(e, 5)
+        except openai.APIConnectionError as e:
             print(" API connection error. Retrying... "\
                   "(if error persists, check network/proxy config/ssl/firewall)")
-            time.sleep(5)
-        except openai.error.InvalidRequestError as e:
-            print(" Invalid request error. Retrying... "\
-                  "(if error persists, check for invalid/missing request parameters)")
-        except openai.error.AuthenticationError as e:
-            print(" Authentication error. Retrying... "\
-                  "(if error persists, check for invalid/expired/revoked API key or token)")
-        except openai.error.ServiceUnavailableError as e:
-            print(" Server is overloaded. Retrying... "\
+            __retry_sleep(e, 5)
+        except openai.InternalServerError as e:
+            print(" Server error or overloaded. Retrying... "\
                   "(if error persists, check status.openai.com)")
-            time.sleep(120)
+            __retry_sleep(e, 30)
+        except (openai.AuthenticationError, openai.PermissionDeniedError, 
+                openai.BadRequestError, openai.NotFoundError) as e:
+            # retrying won't help: invalid/expired key, invalid/missing 
+            # request parameters, unknown model
+            raise
         
     return response_clean
 
@@ -114,7 +170,8 @@ def __make_api_call(client, model, system_content, prompt, temperature):
 def analyze_text(
         text, 
         labels=(topic_labels, sentiment_labels), 
-        prompt_filename="gpt-prompt-combined"
+        prompt_filename="gpt-prompt-combined", 
+        cache=None
     ):
     """
     text: relevant text article
@@ -123,23 +180,33 @@ def analyze_text(
         - When using prompts "gpt-prompt-combined", pass both topic and 
             sentiment labels as (topic_labels, sentiment_labels)
         - Otherwise, pass relevant labels only (there should be only one list). 
+    cache: optional `gpt_cache.ResponseCache`; hits skip the API call
     """
     # API parameters
-    model = 'gpt-4o'
-    system_content = 'You are a knowledgeable and unbiased judge.'
+    model = MODEL
+    system_content = SYSTEM_CONTENT
     n_groups=None
-    temperature = 0
+    temperature = TEMPERATURE
 
     # https://platform.openai.com/docs/guides/text-generation/json-mode
     prompt = __prepare_prompt(text, labels, prompt_filename)
     # print(prompt)
     # return 
+    if cache is not None:
+        response = cache.get(model, system_content, temperature, prompt)
+        if response is not None:
+            return response
+
     client = openai.OpenAI(
         # This is the default and can be omitted
         api_key=API_KEY,
     )
 
-    return __make_api_call(client, model, system_content, prompt, temperature) 
+    response = __make_api_call(client, model, system_content, prompt, temperature)
+    # an invalid answer would be replayed by every later call (temperature 0)
+    if cache is not None and is_valid(response, labels):
+        cache.put(model, system_content, temperature, prompt, response)
+    return response
 
 
 def check(rst, labels=(topic_labels, sentiment_labels)):
@@ -160,4 +227,404 @@ def check(rst, labels=(topic_labels, sentiment_labels)):
 
 
 
+# ---------------------------------------------------------------------------
+# Concurrent batch driver
+# ---------------------------------------------------------------------------
+
+# errors worth retrying; anything else (bad key, bad request) is raised at once
+RETRYABLE_ERRORS = (
+    json.decoder.JSONDecodeError,
+    openai.RateLimitError,          # 429
+    openai.InternalServerError,     # 5xx, including 503 "overloaded"
+    openai.APIConnectionError,      # includes openai.APITimeoutError
+)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for async code.
+
+    Holds up to `capacity` tokens (default: one minute worth) and refills 
+    continuously at `per_minute` tokens per minute. `acquire(n)` waits until
+    `n` tokens are available and takes them. A bucket can be shared by 
+    event loops run one after another (e.g. successive `analyze_many` 
+    calls), which then share its budget instead of each starting full.
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60
+        self.capacity = per_minute if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock, self._loop = None, None
+
+    @property
+    def lock(self):
+        # an asyncio.Lock can only be used in one event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock, self._loop = asyncio.Lock(), loop
+        return self._lock
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, n=1):
+        n = min(n, self.capacity)
+        # holding the lock while sleeping keeps waiters first-come-first-served
+        async with self.lock:
+            self._refill()
+            while self.tokens < n:
+                await asyncio.sleep((n - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= n
+
+
+def estimate_tokens(system_content, prompt, completion_tokens=200):
+    # rough count (~4 chars per token) used for tokens-per-minute budgeting;
+    # `completion_tokens` covers the JSON answer with ~17 label ratings
+    return (len(system_content) + len(prompt)) // 4 + completion_tokens
+
+
+def backoff_delay(attempt, base=1, cap=60):
+    # exponential backoff with "full jitter": uniform in [0, min(cap, base * 2^attempt)]
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def __async_client(client, base_url):
+    # retries must go through the rate limiters and `backoff_delay`, so the 
+    # SDK's own retries are turned off (also on a caller's client)
+    if client is None:
+        return openai.AsyncOpenAI(api_key=API_KEY, base_url=base_url, max_retries=0)
+    return client.with_options(max_retries=0)
+
+
+async def __make_async_api_call(
+        client, model, system_content, prompt, temperature, 
+        request_bucket, token_bucket, max_retries=8, completion_tokens=200
+    ):
+    """
+    Async counterpart of `__make_api_call`: waits on the rate limiters before
+    each attempt, retries transient errors with jittered exponential backoff, 
+    and raises non-retryable errors (or the last error after `max_retries`).
+    """
+    n_tokens = estimate_tokens(system_content, prompt, completion_tokens)
+    for attempt in range(max_retries + 1):
+        with metrics.timer("gpt.rate_limit_wait"):
+            await request_bucket.acquire(1)
+            await token_bucket.acquire(n_tokens)
+        try:
+            with metrics.timer("gpt.request"):
+                chat_completion = await client.chat.completions.create(
+                    model=model,
+                    response_format={"type": "json_object"},
+                    messages=[
+                    {"role": "system", "content": system_content},
+                    {"role": "user", "content": prompt}
+                    ],
+                    temperature = temperature
+                )
+            response = chat_completion.choices[0].message.content
+            return json.loads(response)
+        except RETRYABLE_ERRORS as e:
+            metrics.count("gpt.retries." + type(e).__name__)
+            if attempt == max_retries:
+                raise
+            print(f" {type(e).__name__}. Retrying (attempt {attempt + 1})...")
+            delay = backoff_delay(attempt)
+            metrics.observe("gpt.retry_sleep", delay)
+            await asyncio.sleep(delay)
+
+
+async def __run_prompts(
+        prompts, 
+        model=MODEL, 
+        system_content=SYSTEM_CONTENT, 
+        temperature=TEMPERATURE, 
+        concurrency=16, 
+        rpm=500, 
+        tpm=30000, 
+        client=None, 
+        base_url=None, 
+        max_retries=8, 
+        return_exceptions=False, 
+        cache=None, 
+        limiters=None, 
+        completion_tokens=200, 
+        is_cacheable=None
+    ):
+    """
+    Send every prompt in `prompts` through one shared async client, with at 
+    most `concurrency` requests in flight. Returns parsed JSON responses in 
+    input order.
+
+    Identical prompts are only sent once; with a `cache`, hits are answered 
+    without touching the rate limiters and new responses are stored if 
+    `is_cacheable(prompt, response)` is true (None: all of them), so that 
+    invalid answers are asked again rather than replayed.
+    `limiters` is an optional (request_bucket, token_bucket) pair shared with
+    other calls (otherwise new buckets are made from `rpm` and `tpm`).
+    """
+    own_client = client is None
+    client = __async_client(client, base_url)
+    if limiters is None:
+        limiters = (TokenBucket(rpm), TokenBucket(tpm))
+    request_bucket, token_bucket = limiters
+    semaphore = asyncio.Semaphore(concurrency)
+    # prompts waiting for a slot and requests in flight, for `metrics`
+    depth = {"gpt.queued": 0, "gpt.in_flight": 0}
+
+    def add(name, n):
+        depth[name] += n
+        metrics.gauge(name, depth[name])
+
+    async def run(prompt):
+        if cache is not None:
+            response = cache.get(model, system_content, temperature, prompt)
+            if response is not None:
+                return response
+        add("gpt.queued", 1)
+        async with semaphore:
+            add("gpt.queued", -1)
+            add("gpt.in_flight", 1)
+            try:
+                response = await __make_async_api_call(
+                    client, model, system_content, prompt, temperature, 
+                    request_bucket, token_bucket, max_retries, completion_tokens
+                )
+            finally:
+                add("gpt.in_flight", -1)
+        metrics.count("gpt.responses")
+        if cache is not None and (is_cacheable is None or is_cacheable(prompt, response)):
+            cache.put(model, system_content, temperature, prompt, response)
+        return response
+
+    unique_prompts = list(dict.fromkeys(prompts))
+    metrics.count("gpt.prompts", len(prompts))
+    metrics.count("gpt.duplicate_prompts", len(prompts) - len(unique_prompts))
+    try:
+        responses = await asyncio.gather(
+            *(run(prompt) for prompt in unique_prompts), 
+            return_exceptions=return_exceptions
+        )
+    finally:
+        if own_client:
+            await client.close()
+
+    responses = dict(zip(unique_prompts, responses))
+    return [responses[prompt] for prompt in prompts]
+
+
+def __pack(texts, pack_size, pack_chars):
+    # greedily group consecutive articles: at most `pack_size` articles and
+    # `pack_chars` characters per group (a longer article gets its own group)
+    groups, group, n_chars = [], [], 0
+    for i, text in enumerate(texts):
+        if group and (len(group) == pack_size or n_chars + len(text) > pack_chars):
+            groups.append(group)
+            group, n_chars = [], 0
+        group.append(i)
+        n_chars += len(text)
+    if group:
+        groups.append(group)
+    return groups
+
+
+def is_valid(rst, labels=(topic_labels, sentiment_labels)):
+    # `check` that also rejects non-dict responses and non-numeric ratings
+    try:
+        return isinstance(rst, dict) and check(rst, labels)
+    except TypeError:
+        # non-numeric rating
+        return False
+
+
+async def __analyze_packed(
+        texts, labels, prompt_filename, packed_prompt_filename, 
+        pack_size, pack_chars, client, base_url, rpm, tpm, 
+        return_exceptions, limiters=None, **kwargs
+    ):
+    """
+    Send groups of short articles as single packed prompts, unpack the 
+    per-article results and validate each with `check()`. Articles that are
+    alone in their group, or whose packed result is missing or invalid, are 
+    (re)sent with the regular single-article prompt.
+    """
+    own_client = client is None
+    client = __async_client(client, base_url)
+    if limiters is None:
+        limiters = (TokenBucket(rpm), TokenBucket(tpm))
+    single = get_template(prompt_filename, labels)
+    packed = get_template(packed_prompt_filename, labels)
+
+    try:
+        groups = [g for g in __pack(texts, pack_size, pack_chars) if len(g) > 1]
+        prompts = [packed.render_packed([texts[i] for i in g]) for g in groups]
+        group_sizes = dict(zip(prompts, map(len, groups)))
+
+        def is_cacheable(prompt, response):
+            # a valid result for every article of the group
+            keys = {article_key(k) for k in range(group_sizes[prompt])}
+            return isinstance(response, dict) and response.keys() == keys \
+                and all(is_valid(rst, labels) for rst in response.values())
+
+        responses = await __run_prompts(
+            prompts, client=client, limiters=limiters, return_exceptions=True, 
+            completion_tokens=200 * pack_size, is_cacheable=is_cacheable, **kwargs
+        )
+
+        results = [None] * len(texts)
+        for g, response in zip(groups, responses):
+            if not isinstance(response, dict):
+                continue
+            for k, i in enumerate(g):
+                rst = response.get(article_key(k))
+                if is_valid(rst, labels):
+                    results[i] = rst
+
+        missing = [i for i, rst in enumerate(results) if rst is None]
+        responses = await __run_prompts(
+            [single.render(texts[i]) for i in missing], 
+            client=client, limiters=limiters, return_exceptions=return_exceptions, 
+            is_cacheable=lambda prompt, response: is_valid(response, labels), **kwargs
+        )
+        for i, response in zip(missing, responses):
+            results[i] = response
+        return results
+    finally:
+        if own_client:
+            await client.close()
+
+
+async def analyze_many_async(
+        texts, 
+        labels=(topic_labels, sentiment_labels), 
+        prompt_filename="gpt-prompt-combined", 
+        concurrency=16, 
+        rpm=500, 
+        tpm=30000, 
+        client=None, 
+        base_url=None, 
+        max_retries=8, 
+        return_exceptions=False, 
+        cache=None, 
+        pack_size=1, 
+        pack_chars=8000, 
+        packed_prompt_filename=None, 
+        limiters=None
+    ):
+    """
+    Coroutine version of `analyze_many`, for code that already runs an event
+    loop (e.g. a Jupyter notebook: `results = await analyze_many_async(texts)`).
+    Same arguments and result.
+    """
+    if pack_size > 1:
+        return await __analyze_packed(
+            texts, 
+            labels, 
+            prompt_filename, 
+            packed_prompt_filename or prompt_filename + "-packed", 
+            pack_size, 
+            pack_chars, 
+            client=client, 
+            base_url=base_url, 
+            rpm=rpm, 
+            tpm=tpm, 
+            return_exceptions=return_exceptions, 
+            concurrency=concurrency, 
+            max_retries=max_retries, 
+            cache=cache, 
+            limiters=limiters
+        )
+
+    prompts = [__prepare_prompt(text, labels, prompt_filename) for text in texts]
+    return await __run_prompts(
+        prompts, 
+        concurrency=concurrency, 
+        rpm=rpm, 
+        tpm=tpm, 
+        client=client, 
+        base_url=base_url, 
+        max_retries=max_retries, 
+        return_exceptions=return_exceptions, 
+        cache=cache, 
+        limiters=limiters, 
+        is_cacheable=lambda prompt, response: is_valid(response, labels)
+    )
+
+
+def analyze_many(
+        texts, 
+        labels=(topic_labels, sentiment_labels), 
+        prompt_filename="gpt-prompt-combined", 
+        concurrency=16, 
+        rpm=500, 
+        tpm=30000, 
+        client=None, 
+        base_url=None, 
+        max_retries=8, 
+        return_exceptions=False, 
+        cache=None, 
+        pack_size=1, 
+        pack_chars=8000, 
+        packed_prompt_filename=None, 
+        limiters=None
+    ):
+    """
+    Concurrent version of `analyze_text` over a list of articles.
+
+    texts: list of article texts
+    labels, prompt_filename: as in `analyze_text`
+    concurrency: max number of requests in flight
+    rpm, tpm: requests-per-minute and (estimated) tokens-per-minute limits
+    client: an `openai.AsyncOpenAI` client to reuse; created (and closed) 
+        here if None. The SDK's own retries are turned off either way: 
+        retries are made here, `max_retries` times
+    base_url: API base url for the created client, e.g. a local mock server
+        such as "http://127.0.0.1:8000/v1"
+    return_exceptions: if True, failed articles get the exception object as 
+        their result instead of aborting the whole batch
+    cache: optional `gpt_cache.ResponseCache` shared with `analyze_text`
+    pack_size: if > 1, send up to `pack_size` consecutive short articles 
+        (at most `pack_chars` characters in total) in one request; results 
+        are unpacked per article and validated with `check()`, and articles 
+        that fail are re-sent one by one
+    packed_prompt_filename: packed prompt template; defaults to 
+        `prompt_filename` + "-packed"
+    limiters: (request bucket, token bucket) pair of `TokenBucket`s to 
+        share the rpm/tpm budget across calls; new full buckets if None
+
+    Returns the parsed JSON responses, in the same order as `texts`.
+
+    Runs its own event loop, so it can't be called where one is already 
+    running (e.g. in Jupyter); await `analyze_many_async` there instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError(
+            "analyze_many can't be called from a running event loop (e.g. in Jupyter); "
+            "use `await analyze_many_async(...)` instead"
+        )
 
+    return asyncio.run(analyze_many_async(
+        texts, 
+        labels, 
+        prompt_filename, 
+        concurrency=concurrency, 
+        rpm=rpm, 
+        tpm=tpm, 
+        client=client, 
+        base_url=base_url, 
+        max_retries=max_retries, 
+        return_exceptions=return_exceptions, 
+        cache=cache, 
+        pack_size=pack_size, 
+        pack_chars=pack_chars, 
+        packed_prompt_filename=packed_prompt_filename, 
+        limiters=limiters
+    ))
@@ -0,0 +1,193 @@
+"""
+Checkpointed, resumable GPT labeling over a CSV dataset.
+
+Rows are streamed from the input CSV in chunks, labeled with
+`gpt_helper.analyze_many`, validated with `gpt_helper.check` and appended to a
+JSONL output file (one line per row, flushed after every chunk). On restart,
+rows already in the output or dead-letter file are skipped. Rows that keep
+failing `check()` or fail with a non-retryable error go to the dead-letter
+file instead of blocking the run. Rows that fail with a transient error
+(rate limit, connection, server error) once the retries are used up are 
+written to neither file, so the next run retries them.
+"""
+
+
+import os
+import json
+import openai
+import pandas as pd
+
+import metrics
+import gpt_helper
+from gpt_helper import topic_labels, sentiment_labels
+
+
+# errors that will fail every row the same way (bad key, unknown model):
+# stop the run instead of dead-lettering the whole dataset
+FATAL_ERRORS = (
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+    openai.NotFoundError,
+)
+
+# errors that may go away by themselves (`gpt_helper.RETRYABLE_ERRORS`)
+TRANSIENT_ERRORS = gpt_helper.RETRYABLE_ERRORS
+
+
+def _repair_tail(filename):
+    # drop a partially written last line left by a crash mid-write
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return
+    with open(filename, 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) == b'\n':
+            return
+        f.seek(0)
+        data = f.read()
+        f.truncate(data.rfind(b'\n') + 1)
+
+
+def _is_transient(record):
+    # dead-letter records of transient errors, written by earlier versions
+    names = [e.__name__ for e in TRANSIENT_ERRORS + (openai.APITimeoutError,)]
+    return record.get("error", "").startswith(tuple(name + "(" for name in names))
+
+
+def _read_done_ids(filename):
+    done = set()
+    if not os.path.exists(filename):
+        return done
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                if not _is_transient(record):
+                    done.add(record["row_id"])
+            except (json.decoder.JSONDecodeError, KeyError):
+                continue
+    return done
+
+
+def _append(f, records):
+    for record in records:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def run_dataset(
+        in_filename,
+        out_filename,
+        dead_letter_filename=None,
+        labels=(topic_labels, sentiment_labels),
+        prompt_filename="gpt-prompt-combined",
+        text_column="Article Text",
+        id_column=None,
+        chunksize=256,
+        max_attempts=3,
+        cache=None,
+        rpm=500,
+        tpm=30000,
+        **kwargs
+    ):
+    """
+    Label every row of `in_filename` and append the results to `out_filename`.
+
+    in_filename: input CSV
+    out_filename: output JSONL; each line is {"row_id": ..., <label>: <rating>, ...}
+    dead_letter_filename: JSONL for rows that failed for good; defaults to
+        `out_filename` with ".dead.jsonl" suffix. Each line holds the row id,
+        the error and the last response (if any).
+    labels, prompt_filename: as in `gpt_helper.analyze_text`
+    text_column: column with the article text
+    id_column: column with a unique row id; if None, the row's position in
+        the CSV is used (so the input must not be reordered between restarts)
+    chunksize: rows read (and checkpointed) at a time
+    max_attempts: attempts per row before a response that fails `check()`
+        is dead-lettered
+    cache: optional `gpt_cache.ResponseCache`; it only stores valid 
+        responses, so a retried row is asked again and its corrected answer
+        is stored
+    rpm, tpm: requests-per-minute and tokens-per-minute limits, held over 
+        the whole run (one pair of rate limiters for all chunks)
+    kwargs: passed to `gpt_helper.analyze_many` (concurrency, max_retries, ...)
+
+    Returns (number of rows written, number of rows dead-lettered).
+    """
+    if dead_letter_filename is None:
+        dead_letter_filename = os.path.splitext(out_filename)[0] + ".dead.jsonl"
+    for filename in (out_filename, dead_letter_filename):
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        _repair_tail(filename)
+
+    done = _read_done_ids(out_filename) | _read_done_ids(dead_letter_filename)
+    if done:
+        print(f"Resuming: skipping {len(done)} finished rows")
+
+    usecols = [text_column] if id_column is None else [text_column, id_column]
+    limiters = (gpt_helper.TokenBucket(rpm), gpt_helper.TokenBucket(tpm))
+    n_written, n_dead, n_transient = 0, 0, 0
+    start = 0
+    with open(out_filename, 'a', encoding='utf-8') as out, \
+            open(dead_letter_filename, 'a', encoding='utf-8') as dead:
+        for chunk in pd.read_csv(in_filename, usecols=usecols, chunksize=chunksize):
+            metrics.count("gpt_runner.rows_read", len(chunk))
+            if id_column is None:
+                row_ids = list(range(start, start + len(chunk)))
+            else:
+                # JSON round trip so ids compare equal to the ones read back
+                row_ids = json.loads(json.dumps(chunk[id_column].tolist()))
+            start += len(chunk)
+
+            pending = {
+                row_id: str(text)
+                for row_id, text in zip(row_ids, chunk[text_column])
+                if row_id not in done
+            }
+            results, failures = [], []
+            for attempt in range(max_attempts):
+                if not pending:
+                    break
+                responses = gpt_helper.analyze_many(
+                    list(pending.values()), labels, prompt_filename,
+                    return_exceptions=True,
+                    cache=cache,
+                    limiters=limiters,
+                    **kwargs
+                )
+                retry = {}
+                for (row_id, text), response in zip(pending.items(), responses):
+                    if isinstance(response, FATAL_ERRORS):
+                        raise response
+                    if isinstance(response, TRANSIENT_ERRORS):
+                        # not written: retried by the next run
+                        n_transient += 1
+                    elif isinstance(response, BaseException):
+                        failures.append({"row_id": row_id, "error": repr(response)})
+                    elif gpt_helper.is_valid(response, labels):
+                        results.append({"row_id": row_id, **response})
+                    elif attempt == max_attempts - 1:
+                        failures.append({"row_id": row_id, "error": "check failed", "response": response})
+                    else:
+                        retry[row_id] = text
+                pending = retry
+                metrics.count("gpt_runner.check_retries", len(retry))
+
+            with metrics.timer("gpt_runner.write"):
+                _append(out, results)
+                _append(dead, failures)
+            metrics.count("gpt_runner.rows_written", len(results))
+            metrics.count("gpt_runner.rows_dead", len(failures))
+            n_written += len(results)
+            n_dead += len(failures)
+            print(f"Processed {start} rows ({n_written} written, {n_dead} dead-lettered)")
+
+    if n_transient:
+        print(f"{n_transient} rows failed with transient errors; run again to retry them")
+    return n_written, n_dead
+
+
+def load_results(out_filename):
+    """Read a `run_dataset` output file into a DataFrame indexed by row id."""
+    return pd.read_json(out_filename, lines=True).set_index("row_id")
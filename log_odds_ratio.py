@@ -1,37 +1,67 @@
 # based on https://github.com/kornosk/log-odds-ratio
 
 
+import os
 import math
+import array
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+
+@metrics.timed("log_odds.count_tokens")
+def count_tokens(corpus):
+    """
+    Count whitespace-separated tokens in `corpus`, an iterable of documents 
+    (list, generator, `read_documents(...)`, ...), one document at a time 
+    instead of joining the whole corpus into one string.
+    """
+    counts = Counter()
+    for document in corpus:
+        counts.update(document.split())
+    return counts
+
+
+def read_documents(filename, column="Article Text", chunksize=10000):
+    """Lazily yield the (non-empty) documents in `column` of a CSV file."""
+    for chunk in pd.read_csv(filename, usecols=[column], chunksize=chunksize):
+        for document in chunk[column].dropna():
+            yield str(document)
 
 class LogOddsRatio:
     """
     Log-odds-ratio with informative Dirichlet priors
     """
 
-    def __init__(self, corpus_i, corpus_j, background_corpus=None, preprocess_text=False):
+    def __init__(self, corpus_i, corpus_j, background_corpus=None, preprocess_text=False, min_count=0):
         """
         Create a class object and prepare word counts for log-odds-ratio computation
 
         Args:
             corpus_i:
-                A list of documents, each contains a string
+                A list (or any iterable) of documents, each contains a string
             corpus_j:
-                A list of documents, each contains a string
+                A list (or any iterable) of documents, each contains a string
             background_corpus (default = None):
                 If None, it will be assigned to a concatenation of `corpus_i` and `corpus_j`
+            min_count (default = 0):
+                If > 0, only keep z-scores of words that occur at least 
+                `min_count` times in both corpora
         """
         if preprocess_text:
             raise("preprocess text first")
 
-        if background_corpus == None:
-            background_corpus = corpus_i + corpus_j
-
-        self.y_i = Counter(" ".join(corpus_i).split())
-        self.y_j = Counter(" ".join(corpus_j).split())
-        self.alpha = Counter(" ".join(background_corpus).split())
+        self.y_i = count_tokens(corpus_i)
+        self.y_j = count_tokens(corpus_j)
+        if background_corpus is None:
+            # counts of the concatenation of `corpus_i` and `corpus_j`
+            self.alpha = self.y_i + self.y_j
+        else:
+            self.alpha = count_tokens(background_corpus)
 
 
         # Sort dicts
@@ -49,9 +79,12 @@ class LogOddsRatio:
         self._compute_sigma_2()
         self._compute_z_scores()
 
-        # # filter out words that occurred fewer than 20 times in either corpus. 
-        # words_to_keep = [word for word in self.y_i.keys() & self.y_j.keys() if self.y_i[word] >= 20 and self.y_j[word] >= 20]
-        # self.z_scores = {word: self.z_scores[word] for word in words_to_keep}
+        # filter out words that occurred fewer than `min_count` times in either corpus. 
+        if min_count > 0:
+            self.z_scores = {
+                w: z for w, z in self.z_scores.items() 
+                if self.y_i.get(w, 0) >= min_count and self.y_j.get(w, 0) >= min_count
+            }
 
         # Sort dicts
         self.delta = {k: v for k, v in sorted(self.delta.items(), key=lambda item: item[1], reverse=True)}
@@ -112,8 +145,494 @@ class LogOddsRatio:
             self.z_scores[w] = self.delta.get(w, 0) / math.sqrt(self.sigma_2.get(w, 0))
 
 
-def main(corpus_i, corpus_j, background_corpus=None):
-    log_odds_ratio = LogOddsRatio(corpus_i, corpus_j, background_corpus)
+class LogOddsRatioArrays:
+    """
+    Vectorized log-odds-ratio with informative Dirichlet priors
+
+    Same statistics as `LogOddsRatio`, but the vocabulary is mapped to 
+    integer ids and y_i, y_j and alpha are stored as aligned count arrays, so
+    delta, sigma^2 and z-scores are computed as array expressions and sorted
+    once.
+    """
+
+    def __init__(self, corpus_i, corpus_j, background_corpus=None, min_count=0):
+        """
+        Args:
+            corpus_i:
+                A list (or any iterable) of documents, each contains a string
+            corpus_j:
+                A list (or any iterable) of documents, each contains a string
+            background_corpus (default = None):
+                If None, it will be assigned to a concatenation of `corpus_i` and `corpus_j`
+            min_count (default = 0):
+                If > 0, only keep words that occur at least `min_count` 
+                times in both corpora
+        """
+        y_i = count_tokens(corpus_i)
+        y_j = count_tokens(corpus_j)
+        alpha = y_i + y_j if background_corpus is None else count_tokens(background_corpus)
+        self._init_counts(y_i, y_j, alpha, min_count)
+
+    @classmethod
+    def from_counts(cls, y_i, y_j, alpha, min_count=0):
+        """Build from word -> count mappings instead of raw corpora."""
+        self = cls.__new__(cls)
+        self._init_counts(y_i, y_j, alpha, min_count)
+        return self
+
+    @classmethod
+    def from_arrays(cls, vocab, y_i, y_j, alpha, min_count=0):
+        """Build from a vocabulary and count arrays aligned with it."""
+        self = cls.__new__(cls)
+        self._init_arrays(np.asarray(vocab, dtype=object), y_i, y_j, alpha, min_count)
+        return self
+
+    def _init_counts(self, y_i, y_j, alpha, min_count):
+        words = list(y_i.keys() | y_j.keys() | alpha.keys())
+        self._init_arrays(
+            np.array(words, dtype=object),
+            np.fromiter((y_i.get(w, 0) for w in words), dtype=np.float64, count=len(words)),
+            np.fromiter((y_j.get(w, 0) for w in words), dtype=np.float64, count=len(words)),
+            np.fromiter((alpha.get(w, 0) for w in words), dtype=np.float64, count=len(words)),
+            min_count
+        )
+
+    def _init_arrays(self, vocab, y_i, y_j, alpha, min_count=0):
+        # a word of one corpus that is missing from the other and from the 
+        # background corpus has no prior: `LogOddsRatio` fails on its log(0)
+        undefined = ((y_i > 0) | (y_j > 0)) & ((y_i + alpha == 0) | (y_j + alpha == 0))
+        if undefined.any():
+            words = ", ".join(map(str, vocab[undefined][:5]))
+            raise ValueError(
+                f"{undefined.sum()} words occur in only one corpus and not in the background corpus, e.g. {words}"
+            )
+
+        # background-only words count towards alpha_zero but are not scored
+        delta, sigma_2, z_scores = compute_z_scores(y_i, y_j, alpha)
+        if min_count > 0:
+            scored = (y_i >= min_count) & (y_j >= min_count)
+        else:
+            scored = (y_i > 0) | (y_j > 0)
+
+        self.vocab = vocab[scored]
+        self.word2id = {w: i for i, w in enumerate(self.vocab)}
+        self.y_i = y_i[scored]
+        self.y_j = y_j[scored]
+        self.alpha = alpha[scored]
+        self.delta = delta[scored]
+        self.sigma_2 = sigma_2[scored]
+        self.z_scores = z_scores[scored]
+
+        # word ids by decreasing z-score
+        self.order = np.argsort(-self.z_scores, kind="stable")
+
+    def to_frame(self):
+        """Return the same DataFrame as `main()`: z_score and counts per word, sorted by z_score."""
+        order = self.order
+        df = pd.DataFrame({
+            "z_score": self.z_scores[order],
+            "count1": self.y_i[order],
+            "count2": self.y_j[order],
+            "total_count": self.alpha[order],
+        }, index=self.vocab[order])
+        return df
+
+
+class IncrementalLogOddsRatio:
+    """
+    Log-odds-ratio over corpora that grow over time
+
+    Word counts are kept as arrays over a growing vocabulary; `update()` 
+    streams new documents (any iterable, e.g. `read_documents(...)`) into 
+    them, so history is never recounted. Every z-score depends on the corpus
+    sizes, so `result()` recomputes all of them, but that is a few array 
+    operations over the vocabulary.
+
+    Counts can be saved with `save()` and restored with `load()`.
+    """
+
+    def __init__(self, separate_background=False):
+        """
+        Args:
+            separate_background (default = False):
+                If False, the background corpus is the concatenation of 
+                corpus i and corpus j; if True, background documents are 
+                passed to `update()` separately
+        """
+        self.separate_background = separate_background
+        self.words = []
+        self.word2id = {}
+        # rows: corpus i, corpus j, background corpus
+        self.counts = np.zeros((3, 0), dtype=np.float64)
+
+    def update(self, corpus_i=(), corpus_j=(), background_corpus=None):
+        """Add documents (iterables of strings) to the counts."""
+        corpora = [corpus_i, corpus_j]
+        if self.separate_background:
+            corpora.append(background_corpus or ())
+        elif background_corpus is not None:
+            raise ValueError("pass separate_background=True to count a background corpus")
+
+        for row, corpus in enumerate(corpora):
+            counts = count_tokens(corpus)
+            if not counts:
+                continue
+            new_words = [w for w in counts if w not in self.word2id]
+            for w in new_words:
+                self.word2id[w] = len(self.words)
+                self.words.append(w)
+            if new_words:
+                self.counts = np.pad(self.counts, ((0, 0), (0, len(new_words))))
+            ids = np.fromiter((self.word2id[w] for w in counts), dtype=np.int64, count=len(counts))
+            self.counts[row, ids] += np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+        return self
+
+    def result(self, min_count=0):
+        """Current scores as a `LogOddsRatioArrays`."""
+        y_i, y_j, background = self.counts
+        alpha = background if self.separate_background else y_i + y_j
+        return LogOddsRatioArrays.from_arrays(self.words, y_i, y_j, alpha, min_count)
+
+    def to_frame(self, min_count=0):
+        """Current scores as the DataFrame returned by `main()`."""
+        return self.result(min_count).to_frame()
+
+    def save(self, filename):
+        # tokens never contain whitespace, so the vocabulary is stored newline-joined
+        np.savez_compressed(
+            filename, 
+            counts=self.counts, 
+            words=np.array("\n".join(self.words)), 
+            separate_background=self.separate_background
+        )
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        self = cls(separate_background=bool(data["separate_background"]))
+        self.words = str(data["words"]).split("\n") if data["counts"].shape[1] else []
+        self.word2id = {w: i for i, w in enumerate(self.words)}
+        self.counts = data["counts"]
+        return self
+
+
+def compute_z_scores(y_i, y_j, alpha):
+    """
+    Delta, sigma squared and z-scores for aligned count arrays
+
+    Args:
+        y_i, y_j, alpha:
+            Count arrays (word counts in corpus i, corpus j and the 
+            background corpus) over the full vocabulary; the corpus sizes are 
+            their sums. Leading axes broadcast, e.g. (K, V) arrays score K 
+            comparisons at once.
+    """
+    n_i = y_i.sum(axis=-1, keepdims=True)
+    n_j = y_j.sum(axis=-1, keepdims=True)
+    alpha_zero = alpha.sum(axis=-1, keepdims=True)
+
+    y_i_alpha = y_i + alpha
+    y_j_alpha = y_j + alpha
+    delta = np.log10(y_i_alpha / (n_i + alpha_zero - y_i_alpha)) \
+        - np.log10(y_j_alpha / (n_j + alpha_zero - y_j_alpha))
+    sigma_2 = 1 / y_i_alpha + 1 / y_j_alpha
+    z_scores = delta / np.sqrt(sigma_2)
+    return delta, sigma_2, z_scores
+
+
+@metrics.timed("log_odds.document_term_matrix")
+def document_term_matrix(corpus, vocab=None):
+    """
+    Sparse document-term count matrix
+
+    Args:
+        corpus:
+            A list (or any iterable) of documents, each contains a string
+        vocab (default = None):
+            Fixed list of words (columns); other words are ignored. If None, 
+            the vocabulary is every word in `corpus`, in order of appearance.
+
+    Returns (csr_matrix of shape (n_documents, len(vocab)), vocab)
+    """
+    grow = vocab is None
+    vocab = [] if grow else list(vocab)
+    word2id = {w: i for i, w in enumerate(vocab)}
+    indptr, indices, data = array.array('q', [0]), array.array('q'), array.array('q')
+
+    for document in corpus:
+        for w, c in Counter(document.split()).items():
+            i = word2id.get(w)
+            if i is None:
+                if not grow:
+                    continue
+                i = word2id[w] = len(vocab)
+                vocab.append(w)
+            indices.append(i)
+            data.append(c)
+        indptr.append(len(indices))
+
+    X = sparse.csr_matrix(
+        (np.frombuffer(data, dtype=np.int64), np.frombuffer(indices, dtype=np.int64), np.frombuffer(indptr, dtype=np.int64)),
+        shape=(len(indptr) - 1, len(vocab))
+    )
+    return X, vocab
+
+
+def group_counts(X, groups):
+    """
+    Sum the rows of document-term matrix `X` by group label.
+
+    Returns (group names, (n_groups, n_words) count array)
+    """
+    names, group_ids = np.unique(np.asarray(groups), return_inverse=True)
+    indicator = sparse.csr_matrix(
+        (np.ones(len(group_ids)), (group_ids, np.arange(len(group_ids)))),
+        shape=(len(names), len(group_ids))
+    )
+    return names, np.asarray((indicator @ X).todense(), dtype=np.float64)
+
+
+def group_log_odds(corpus, groups, min_count=0, pairwise=False, X=None, vocab=None):
+    """
+    Log-odds-ratio z-scores for K groups of documents at once
+
+    Builds one sparse document-term matrix, sums it by group, and scores 
+    every group against the rest of the corpus (one-vs-rest) and, with 
+    `pairwise`, every pair of groups -- each as a single array expression over
+    all groups/pairs. The background corpus of a comparison is the 
+    concatenation of the two sides, as in `main()`.
+
+    Args:
+        corpus:
+            A list of documents, each contains a string
+        groups:
+            Group label (district, year, ...) of each document
+        min_count (default = 0):
+            Drop words that occur fewer than `min_count` times on either 
+            side of a comparison
+        pairwise (default = False):
+            Also score all pairs of groups
+        X, vocab (default = None):
+            Precomputed `document_term_matrix(corpus)`, or the same from a 
+            corpus store (`store.view("words").document_term_matrix(keys)`);
+            `corpus` is then not read
+
+    Returns a tidy DataFrame with columns word, group, other ("rest" for 
+    one-vs-rest, else the other group), z_score, count1, count2, total_count; 
+    sorted by comparison and decreasing z_score.
+    """
+    if X is None:
+        X, vocab = document_term_matrix(corpus)
+    names, counts = group_counts(X, groups)
+    total = counts.sum(axis=0)
+
+    # one-vs-rest: K comparisons
+    y_i = counts
+    y_j = total - counts
+    group = names
+    other = np.full(len(names), "rest", dtype=object)
+    if pairwise:
+        a, b = np.triu_indices(len(names), 1)
+        y_i = np.concatenate([y_i, counts[a]])
+        y_j = np.concatenate([y_j, counts[b]])
+        group = np.concatenate([group, names[a]])
+        other = np.concatenate([other, names[b]])
+
+    alpha = y_i + y_j
+    # words absent from both sides of a comparison give inf/nan; dropped below
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta, sigma_2, z_scores = compute_z_scores(y_i, y_j, alpha)
+
+    if min_count > 0:
+        keep = (y_i >= min_count) & (y_j >= min_count)
+    else:
+        keep = (y_i > 0) | (y_j > 0)
+    comparison, word = np.nonzero(keep)
+    z = z_scores[comparison, word]
+    order = np.lexsort((-z, comparison))
+    comparison, word, z = comparison[order], word[order], z[order]
+
+    vocab = np.asarray(vocab, dtype=object)
+    return pd.DataFrame({
+        "word": vocab[word],
+        "group": group[comparison],
+        "other": other[comparison],
+        "z_score": z,
+        "count1": y_i[comparison, word],
+        "count2": y_j[comparison, word],
+        "total_count": alpha[comparison, word],
+    })
+
+
+_bootstrap_data = {}
+
+def _init_bootstrap_worker(X_i, X_j, tracked, eligible):
+    # per-process copy of the per-document count matrices
+    _bootstrap_data.update(X_i=X_i.T.tocsr(), X_j=X_j.T.tocsr(), tracked=tracked, eligible=eligible)
+
+
+def _bootstrap_replicates(seeds):
+    """
+    Run one bootstrap replicate per seed: resample the documents of each 
+    corpus with replacement, rebuild the counts as (word x document) matrix 
+    times (document multiplicity) vector, and score. Returns the z-scores and
+    ranks (1 = highest z) of the tracked words, and the number of scored 
+    words, per replicate. Ranks are among the eligible words (those ranked 
+    on the full data), so that they compare with the full-data ranks.
+    """
+    X_i, X_j, tracked = _bootstrap_data["X_i"], _bootstrap_data["X_j"], _bootstrap_data["tracked"]
+    eligible = _bootstrap_data["eligible"]
+    z_out = np.empty((len(seeds), len(tracked)))
+    rank_out = np.empty((len(seeds), len(tracked)))
+    n_scored = np.empty(len(seeds))
+
+    for r, seed in enumerate(seeds):
+        rng = np.random.default_rng(seed)
+        n_i, n_j = X_i.shape[1], X_j.shape[1]
+        y_i = X_i @ np.bincount(rng.integers(0, n_i, n_i), minlength=n_i).astype(np.float64)
+        y_j = X_j @ np.bincount(rng.integers(0, n_j, n_j), minlength=n_j).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            _, _, z_scores = compute_z_scores(y_i, y_j, y_i + y_j)
+
+        # words absent from both resampled corpora are not scored
+        scored = ((y_i > 0) | (y_j > 0)) & eligible
+        z_scores[~scored] = np.nan
+        sorted_z = np.sort(z_scores[scored])
+        z = z_scores[tracked]
+        z_out[r] = z
+        rank_out[r] = np.where(np.isnan(z), np.nan, len(sorted_z) - np.searchsorted(sorted_z, z, side="right") + 1)
+        n_scored[r] = len(sorted_z)
+
+    return z_out, rank_out, n_scored
+
+
+def bootstrap_log_odds(
+        corpus_i, corpus_j, n_boot=1000, top_n=50, ci=0.95, seed=0, n_jobs=None, min_count=0
+    ):
+    """
+    Bootstrap confidence intervals and rank stability for the top words
+
+    Documents are resampled with replacement as index arrays over 
+    precomputed per-document count vectors (a sparse document-term matrix), 
+    so a replicate costs one sparse matrix-vector product per corpus instead
+    of recounting text. Replicates run in a process pool; replicate r uses 
+    the r-th child of `numpy.random.SeedSequence(seed)`, so results do not 
+    depend on `n_jobs`. The background corpus is the concatenation of the 
+    two corpora.
+
+    Args:
+        corpus_i, corpus_j:
+            Lists of documents, each contains a string
+        n_boot (default = 1000):
+            Number of bootstrap replicates
+        top_n (default = 50):
+            Track the `top_n` highest and `top_n` lowest scoring words
+        ci (default = 0.95):
+            Confidence level of the intervals
+        seed (default = 0):
+            Seed of the replicate RNGs
+        n_jobs (default = None):
+            Number of worker processes; all cores if None, in-process if 1
+        min_count (default = 0):
+            As in `main()`; words below it on the full data are neither 
+            tracked nor ranked, in the replicates too
+
+    Returns a DataFrame indexed by word, sorted by z_score, with columns 
+    z_score (full data), ci_low, ci_high, rank (full data, 1 = highest), 
+    median_rank, rank_ci_low, rank_ci_high and top_n_frac (fraction of 
+    replicates in which the word stays among the `top_n` words on its side).
+    """
+    corpus_i, corpus_j = list(corpus_i), list(corpus_j)
+    X, vocab = document_term_matrix(corpus_i + corpus_j)
+    X_i, X_j = X[:len(corpus_i)], X[len(corpus_i):]
+    vocab = np.asarray(vocab, dtype=object)
+
+    y_i = np.asarray(X_i.sum(axis=0), dtype=np.float64).ravel()
+    y_j = np.asarray(X_j.sum(axis=0), dtype=np.float64).ravel()
+    _, _, z_scores = compute_z_scores(y_i, y_j, y_i + y_j)
+    if min_count > 0:
+        eligible = (y_i >= min_count) & (y_j >= min_count)
+    else:
+        eligible = np.ones(len(vocab), dtype=bool)
+    scored = np.flatnonzero(eligible)
+    order = scored[np.argsort(-z_scores[scored], kind="stable")]
+    top_n = min(top_n, len(order) // 2)
+    tracked = np.concatenate([order[:top_n], order[len(order) - top_n:]])
+    high = np.arange(len(tracked)) < top_n
+
+    seeds = np.random.SeedSequence(seed).spawn(n_boot)
+    n_jobs = n_jobs or os.cpu_count()
+    with metrics.timer("log_odds.bootstrap"):
+        if n_jobs == 1:
+            _init_bootstrap_worker(X_i, X_j, tracked, eligible)
+            results = [_bootstrap_replicates(seeds)]
+        else:
+            chunks = [list(c) for c in np.array_split(np.array(seeds, dtype=object), n_jobs * 4) if len(c)]
+            with ProcessPoolExecutor(n_jobs, initializer=_init_bootstrap_worker, initargs=(X_i, X_j, tracked, eligible)) as pool:
+                results = list(pool.map(_bootstrap_replicates, chunks))
+    metrics.count("log_odds.bootstrap_replicates", n_boot)
+    z_boot = np.concatenate([r[0] for r in results])
+    rank_boot = np.concatenate([r[1] for r in results])
+    n_scored = np.concatenate([r[2] for r in results])
+
+    tail = (1 - ci) / 2 * 100
+    # rank counted from the end the word is on
+    side_rank = np.where(high, rank_boot, n_scored[:, None] - rank_boot + 1)
+    full_rank = np.empty(len(vocab))
+    full_rank[order] = np.arange(1, len(order) + 1)
+
+    with np.errstate(invalid="ignore"):
+        df = pd.DataFrame({
+            "z_score": z_scores[tracked],
+            "ci_low": np.nanpercentile(z_boot, tail, axis=0),
+            "ci_high": np.nanpercentile(z_boot, 100 - tail, axis=0),
+            "rank": full_rank[tracked],
+            "median_rank": np.nanmedian(rank_boot, axis=0),
+            "rank_ci_low": np.nanpercentile(rank_boot, tail, axis=0),
+            "rank_ci_high": np.nanpercentile(rank_boot, 100 - tail, axis=0),
+            "top_n_frac": (side_rank <= top_n).mean(axis=0),
+        }, index=vocab[tracked])
+    return df
+
+
+def store_counts(store, corpus):
+    """
+    Total token counts of `corpus` (list of documents) read from the "words"
+    view of `store`, a `corpus_store.CorpusStore`; documents it doesn't have
+    yet are added first. Returns (count array, vocab).
+    """
+    keys = store.add(corpus, ("words",))
+    X, vocab = store.view("words").document_term_matrix(keys)
+    return np.asarray(X.sum(axis=0), dtype=np.float64).ravel(), vocab
+
+
+def main(corpus_i, corpus_j, background_corpus=None, engine="numpy", min_count=0, store=None):
+    """
+    Log-odds-ratio z-scores and counts per word, sorted by z-score
+
+    engine: "numpy" (`LogOddsRatioArrays`) or "python" (`LogOddsRatio`)
+    min_count: if > 0, only keep words that occur at least `min_count` times
+        in both corpora
+    store: optional `corpus_store.CorpusStore` to read the tokenized 
+        documents from (numpy engine only)
+    """
+    if store is not None:
+        if engine != "numpy":
+            raise ValueError("store is only supported with engine='numpy'")
+        # the store's vocabulary only grows: pad earlier counts to the latest
+        y_i, _ = store_counts(store, list(corpus_i))
+        y_j, vocab = store_counts(store, list(corpus_j))
+        if background_corpus is not None:
+            alpha, vocab = store_counts(store, list(background_corpus))
+        n = len(vocab)
+        y_i, y_j = np.pad(y_i, (0, n - len(y_i))), np.pad(y_j, (0, n - len(y_j)))
+        alpha = y_i + y_j if background_corpus is None else alpha
+        return LogOddsRatioArrays.from_arrays(vocab, y_i, y_j, alpha, min_count).to_frame()
+
+    if engine == "numpy":
+        return LogOddsRatioArrays(corpus_i, corpus_j, background_corpus, min_count).to_frame()
+
+    log_odds_ratio = LogOddsRatio(corpus_i, corpus_j, background_corpus, min_count=min_count)
     data = {}
     # with open("results/log-odds-result.csv", "w") as f:
         # f.write("word,z_score,count1,count2,total_count\n")
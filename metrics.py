@@ -0,0 +1,293 @@
+"""
+Run metrics: counters, gauges, timers and histograms shared by the modules.
+
+Off by default. When disabled, every call returns right after checking one
+flag (`timer` returns a shared no-op context manager), so the instrumented
+code paths cost about one function call. When enabled:
+
+    import metrics
+    metrics.enable("data/metrics.json", interval=60, profile_filename="data/profile.txt")
+    ...
+    metrics.disable()   # also done at exit
+
+Progress lines with the counters' throughput since the last line go to
+stderr every `interval` seconds. The final summary is written as JSON: each
+counter's total and rate, each gauge's last and max value, and the count,
+sum and approximate percentiles of each histogram (timers are histograms of
+seconds). With `profile_filename`, a sampling profiler records the stacks of
+the running threads every `profile_interval` seconds. They are written as
+collapsed stacks ("frame;frame;frame count" lines), as read by
+flamegraph.pl and speedscope.
+
+It can also be switched on without code changes, e.g. in an sbatch script,
+with the METRICS_SUMMARY (summary file), METRICS_INTERVAL and
+METRICS_PROFILE environment variables. "{pid}" in a filename is replaced by
+the process id, so that pool workers don't overwrite each other's files.
+"""
+
+
+import os
+import sys
+import json
+import math
+import time
+import atexit
+import functools
+import threading
+import contextlib
+from collections import Counter
+
+
+class Histogram:
+    """Count, sum, min, max and power-of-two buckets of observed values."""
+
+    __slots__ = ("count", "sum", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = Counter()
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        # bucket e holds values in [2^(e-1), 2^e)
+        self.buckets[math.frexp(value)[1] if value > 0 else None] += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-quantile, within [min, max]
+        rank = q * self.count
+        seen = 0
+        for e in sorted(self.buckets, key=lambda e: -math.inf if e is None else e):
+            seen += self.buckets[e]
+            if seen >= rank:
+                upper = 0.0 if e is None else 2.0 ** e
+                return min(max(upper, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+_null_timer = contextlib.nullcontext()
+
+_enabled = False
+_lock = threading.Lock()
+_counters = Counter()
+_gauges = {}
+_histograms = {}
+_config = {}
+_threads = []
+_stop = threading.Event()
+
+
+def enabled():
+    return _enabled
+
+
+def count(name, n=1):
+    """Add `n` to counter `name` (items processed, retries, cache hits, ...)."""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += n
+
+
+def gauge(name, value):
+    """Set gauge `name` (queue depth, requests in flight, ...); its max is kept too."""
+    if not _enabled:
+        return
+    with _lock:
+        peak = _gauges.get(name, (value, value))[1]
+        _gauges[name] = (value, max(peak, value))
+
+
+def observe(name, value):
+    """Add `value` to histogram `name`."""
+    if not _enabled:
+        return
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].add(value)
+
+
+def timer(name):
+    """Context manager adding the seconds spent in its block to histogram `name`."""
+    if not _enabled:
+        return _null_timer
+    return _Timer(name)
+
+
+def timed(name):
+    """Decorator form of `timer`."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return f(*args, **kwargs)
+            with _Timer(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    """Current metrics as a dict (see module docstring)."""
+    with _lock:
+        elapsed = time.monotonic() - _config["start"] if _config else 0.0
+        return {
+            "pid": os.getpid(),
+            "elapsed": elapsed,
+            "counters": {
+                name: {"count": n, "per_sec": n / elapsed if elapsed > 0 else 0.0}
+                for name, n in sorted(_counters.items())
+            },
+            "gauges": {name: {"last": last, "max": peak} for name, (last, peak) in sorted(_gauges.items())},
+            "histograms": {name: h.to_dict() for name, h in sorted(_histograms.items())},
+        }
+
+
+def _progress_loop(interval, stream):
+    previous, previous_time = Counter(), time.monotonic()
+    while not _stop.wait(interval):
+        now = time.monotonic()
+        with _lock:
+            counters, gauges = Counter(_counters), dict(_gauges)
+            timers = {name: (h.count, h.sum) for name, h in _histograms.items()}
+        rate = lambda name: (counters[name] - previous[name]) / (now - previous_time)
+        parts = [f"{name}={n} ({rate(name):.1f}/s)" for name, n in sorted(counters.items())]
+        parts += [f"{name}={last}" for name, (last, _) in sorted(gauges.items())]
+        parts += [f"{name}={total:.1f}s/{n}" for name, (n, total) in sorted(timers.items())]
+        elapsed = time.strftime("%H:%M:%S", time.gmtime(now - _config["start"]))
+        print(f"[metrics {elapsed}] " + " ".join(parts), file=stream, flush=True)
+        previous, previous_time = counters, now
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _profile_loop(interval, stacks):
+    own = threading.get_ident()
+    while not _stop.wait(interval):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own or thread_id in _config["ignored_threads"]:
+                continue
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            stacks[';'.join(reversed(names))] += 1
+
+
+def _filename(filename):
+    return filename.replace("{pid}", str(os.getpid())) if filename else None
+
+
+def enable(summary_filename=None, interval=60.0, profile_filename=None, profile_interval=0.005, stream=None):
+    """
+    Start collecting metrics (resetting any collected so far).
+
+    summary_filename: JSON summary written by `disable()` (or at exit)
+    interval: seconds between progress lines; None or 0 for none
+    profile_filename: if set, run the sampling profiler and write collapsed
+        stacks there
+    profile_interval: seconds between profiler samples
+    stream: where progress lines go (default stderr)
+    """
+    global _enabled
+    if _enabled:
+        disable()
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+        _config.clear()
+        _config.update(
+            start=time.monotonic(),
+            summary_filename=_filename(summary_filename),
+            profile_filename=_filename(profile_filename),
+            stacks=Counter(),
+            ignored_threads=set(),
+        )
+    _stop.clear()
+    if interval:
+        _threads.append(threading.Thread(
+            target=_progress_loop, args=(interval, stream or sys.stderr), daemon=True, name="metrics-progress"
+        ))
+    if profile_filename:
+        _threads.append(threading.Thread(
+            target=_profile_loop, args=(profile_interval, _config["stacks"]), daemon=True, name="metrics-profiler"
+        ))
+    for thread in _threads:
+        thread.start()
+        _config["ignored_threads"].add(thread.ident)
+    _enabled = True
+
+
+def disable():
+    """Stop collecting, write the summary and profile files; returns the summary."""
+    global _enabled
+    if not _enabled:
+        return None
+    _enabled = False
+    _stop.set()
+    for thread in _threads:
+        thread.join()
+    _threads.clear()
+
+    result = summary()
+    filename = _config["summary_filename"]
+    if filename:
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(result, f, indent=2)
+    filename = _config["profile_filename"]
+    if filename:
+        with open(filename, 'w') as f:
+            for stack, n in _config["stacks"].most_common():
+                f.write(f"{stack} {n}\n")
+    return result
+
+
+atexit.register(disable)
+
+if os.environ.get("METRICS_SUMMARY") or os.environ.get("METRICS_PROFILE"):
+    enable(
+        os.environ.get("METRICS_SUMMARY"),
+        float(os.environ.get("METRICS_INTERVAL", 60)),
+        os.environ.get("METRICS_PROFILE"),
+    )
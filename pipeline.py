@@ -0,0 +1,464 @@
+"""
+One command for the article analyses, run as a pipeline of cached stages.
+
+    python pipeline.py --input data/df-processed.csv --output-dir data/pipeline
+    python pipeline.py --input data/df-processed.csv --stages vad,log_odds \\
+        --config pipeline.json --merge data/df-labeled.csv
+
+Stages (see `STAGES` for their options, which --config overrides per stage
+with a JSON file such as {"gpt": {"concurrency": 32}, "log_odds": {"group_column": "District"}}):
+
+    relevancy_zsc  zero-shot relevancy scores          (columns)
+    topic_zsc      zero-shot topic scores; by default   (columns)
+                   only for articles that relevancy_zsc
+                   scores as relevant
+    gpt            GPT topic and sentiment ratings      (columns)
+    vad            ANEW valence, arousal, dominance     (columns)
+    log_odds       log-odds z-scores by group           (table)
+    word2vec       ensemble of word2vec models          (directory)
+
+Every stage output goes into its own directory,
+output_dir/<stage>/<key>, where the key hashes the stage's options and
+version, the input columns it reads, and the keys of the stages it depends
+on. A stage whose key already has a finished output is skipped, so changing
+one stage's options only reruns that stage and the stages downstream of it.
+Column stages write only their own columns (columns.csv, one row per input
+row, in order) instead of rewriting the whole dataset; --merge joins them
+onto the input once at the end. output_dir/manifest.json records the
+output of each stage of the last run.
+
+Stages whose dependencies are done run at the same time, each in its own
+process (at most --max-parallel), e.g. vad and gpt.
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TEXT = "Article Text"
+
+
+class Stage:
+    """
+    A pipeline stage.
+
+    Args:
+        run:
+            Function (df, inputs, options, out_dir) -> DataFrame of new
+            columns (kind "columns", same row order as `df`) or None (other
+            kinds, which write their files to `out_dir`). `df` holds the
+            input columns the stage reads; `inputs` maps each dependency to
+            its output (a DataFrame for column stages, else a directory).
+        kind:
+            "columns", "table" or "directory"
+        defaults:
+            Options and their default values
+        depends (default = ()):
+            Function options -> names of the stages this one needs
+        columns (default = ()):
+            Function options -> input columns besides the text column
+        version (default = 1):
+            Part of the cache key; bump it when the stage's output changes
+            for the same options
+    """
+
+    def __init__(self, run, kind, defaults, depends=None, columns=None, version=1):
+        self.run = run
+        self.kind = kind
+        self.defaults = defaults
+        self.depends = depends or (lambda options: ())
+        self.columns = columns or (lambda options: ())
+        self.version = version
+
+
+def _zsc(df, labels, options):
+    import run_zero_shot_classification as zsc
+    engine = zsc.ZeroShotEngine(options["model"], options["device"])
+    result = zsc.f_zero_shot_multi(
+        df[[TEXT]].copy(), {"labels": labels}, engine=engine,
+        batch_size=options["batch_size"], chunk_size=options["chunk_size"]
+    )
+    return result.drop(columns=[TEXT])
+
+
+def run_relevancy_zsc(df, inputs, options, out_dir):
+    import run_zero_shot_classification as zsc
+    return _zsc(df, zsc.relevancy_labels, options)
+
+
+def run_topic_zsc(df, inputs, options, out_dir):
+    import run_zero_shot_classification as zsc
+    if not options["gate"]:
+        return _zsc(df, zsc.topic_labels, options)
+
+    relevancy = inputs["relevancy_zsc"][zsc.label_column(zsc.relevancy_labels[0])].to_numpy()
+    rows = np.flatnonzero(relevancy >= options["threshold"])
+    print(f"topic_zsc: {len(rows)} / {len(df)} articles are relevant")
+    columns = [zsc.label_column(label) for label in zsc.topic_labels]
+    result = pd.DataFrame(np.nan, index=df.index, columns=columns)
+    if len(rows):
+        scores = _zsc(df.iloc[rows].reset_index(drop=True), zsc.topic_labels, options)
+        result.iloc[rows] = scores[columns].to_numpy()
+    return result
+
+
+def run_gpt(df, inputs, options, out_dir):
+    import gpt_helper
+    from gpt_batch import column_name
+    from gpt_runner import FATAL_ERRORS
+
+    # the stage runs in its own process: a key set in the caller's
+    # gpt_helper doesn't reach it, so fall back to the environment
+    gpt_helper.API_KEY = gpt_helper.API_KEY or os.environ.get("OPENAI_API_KEY", "")
+    labels = (gpt_helper.topic_labels, gpt_helper.sentiment_labels)
+    # prompt files are looked up next to this script unless found as given
+    prompt_filename = options["prompt_filename"]
+    if not os.path.exists(prompt_filename):
+        prompt_filename = os.path.join(ROOT, prompt_filename)
+    cache = None
+    if options["cache"]:
+        from gpt_cache import ResponseCache
+        cache = ResponseCache(options["cache"])
+    responses = gpt_helper.analyze_many(
+        [str(text) for text in df[TEXT]], labels, prompt_filename,
+        concurrency=options["concurrency"], rpm=options["rpm"], tpm=options["tpm"],
+        base_url=options["base_url"], return_exceptions=True, cache=cache, pack_size=options["pack_size"]
+    )
+
+    # failed requests must fail the stage, or their NaNs would be cached as
+    # its output; rows that did get an answer are in `cache` for the rerun
+    errors = [response for response in responses if isinstance(response, BaseException)]
+    for error in errors:
+        if isinstance(error, FATAL_ERRORS):
+            # as in gpt_runner, but re-raised as a RuntimeError: openai's
+            # errors can't be unpickled in the parent process
+            raise RuntimeError(f"gpt: {error!r}") from error
+    if len(errors) > options["max_failed"] * len(responses):
+        raise RuntimeError(f"gpt: {len(errors)} / {len(responses)} requests failed, e.g. {errors[0]!r}")
+
+    flat_labels = labels[0] + labels[1]
+    valid = [gpt_helper.is_valid(response, labels) for response in responses]
+    result = pd.DataFrame({
+        column_name(label): [r[label] if ok else np.nan for r, ok in zip(responses, valid)]
+        for label in flat_labels
+    }, index=df.index)
+    result["GPT-valid"] = valid
+    print(f"gpt: {sum(valid)} / {len(valid)} rows with valid results")
+    return result
+
+
+def run_vad(df, inputs, options, out_dir):
+    sys.path.insert(0, os.path.join(ROOT, "VAD"))
+    import anew_vad_analysis
+    result = anew_vad_analysis.analyze_texts(
+        df[TEXT], n_jobs=options["n_jobs"], chunksize=options["chunksize"]
+    )
+    return result.set_axis(df.index)
+
+
+def run_log_odds(df, inputs, options, out_dir):
+    import log_odds_ratio
+    if not options["group_column"]:
+        raise ValueError("log_odds needs the 'group_column' option")
+    df = df.dropna(subset=[TEXT, options["group_column"]])
+    result = log_odds_ratio.group_log_odds(
+        [str(text) for text in df[TEXT]], df[options["group_column"]].astype(str).tolist(),
+        min_count=options["min_count"], pairwise=options["pairwise"]
+    )
+    result.to_csv(os.path.join(out_dir, "log_odds.csv"), index=False)
+
+
+def run_word2vec(df, inputs, options, out_dir):
+    import word2vec_main
+    word2vec_main.main(
+        [str(text) for text in df[TEXT].dropna()], output_dir=out_dir,
+        bootstrap=options["bootstrap"], num_runs=options["num_runs"], dim=options["dim"],
+        window=options["window"], n_jobs=options["n_jobs"], seed=options["seed"]
+    )
+
+
+_zsc_defaults = {"model": "facebook/bart-large-mnli", "device": None, "batch_size": 16, "chunk_size": 256}
+
+STAGES = {
+    "relevancy_zsc": Stage(run_relevancy_zsc, "columns", dict(_zsc_defaults)),
+    "topic_zsc": Stage(
+        run_topic_zsc, "columns", dict(_zsc_defaults, gate=True, threshold=0.5),
+        depends=lambda options: ("relevancy_zsc",) if options["gate"] else ()
+    ),
+    # max_failed: fraction of requests that may fail without failing the stage
+    "gpt": Stage(run_gpt, "columns", {
+        "prompt_filename": "gpt-prompt-combined", "concurrency": 16, "rpm": 500, "tpm": 30000,
+        "pack_size": 1, "cache": "data/gpt-cache.sqlite", "base_url": None, "max_failed": 0.0,
+    }),
+    "vad": Stage(run_vad, "columns", {"n_jobs": None, "chunksize": 64}),
+    "log_odds": Stage(
+        run_log_odds, "table", {"group_column": None, "min_count": 0, "pairwise": False},
+        columns=lambda options: (options["group_column"],) if options["group_column"] else ()
+    ),
+    "word2vec": Stage(run_word2vec, "directory", {
+        "bootstrap": True, "num_runs": 50, "dim": 100, "window": 5, "n_jobs": 1, "seed": 0,
+    }),
+}
+
+DEFAULT_STAGES = ("relevancy_zsc", "topic_zsc", "gpt", "vad")
+
+
+def column_hash(series):
+    """Hash of a column's values (not of the file around it)."""
+    values = pd.util.hash_pandas_object(series, index=False).to_numpy()
+    return hashlib.sha256(values.tobytes()).hexdigest()
+
+
+def plan(names, options, input_hashes):
+    """
+    Add the dependencies of the stages `names` and order them so that every
+    stage comes after the ones it depends on; returns {name: key}.
+    """
+    keys = {}
+
+    def visit(name, path=()):
+        if name in keys:
+            return
+        if name in path:
+            raise ValueError(f"dependency cycle: {' -> '.join(path + (name,))}")
+        stage = STAGES[name]
+        depends = stage.depends(options[name])
+        for dependency in depends:
+            visit(dependency, path + (name,))
+        payload = json.dumps({
+            "stage": name,
+            "version": stage.version,
+            "options": options[name],
+            "inputs": {column: input_hashes[column] for column in (TEXT,) + tuple(stage.columns(options[name]))},
+            "depends": {dependency: keys[dependency] for dependency in depends},
+        }, sort_keys=True, default=str)
+        keys[name] = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+    for name in names:
+        visit(name)
+    return keys
+
+
+def output_dir_of(output_dir, name, key):
+    return os.path.join(output_dir, name, key)
+
+
+def is_done(out_dir):
+    return os.path.exists(os.path.join(out_dir, "DONE"))
+
+
+def load_output(out_dir, kind):
+    """A stage output: DataFrame of columns for column stages, else the directory."""
+    if kind == "columns":
+        return pd.read_csv(os.path.join(out_dir, "columns.csv"))
+    return out_dir
+
+
+def run_stage(name, input_filename, columns, text_column, options, dependency_dirs, out_dir):
+    """
+    Run stage `name` on `columns` of `input_filename` (`text_column` is 
+    passed to the stage as "Article Text") and write its output to `out_dir`
+    (through a temporary directory, renamed when complete). Returns the 
+    seconds spent.
+    """
+    start = time.perf_counter()
+    stage = STAGES[name]
+    df = pd.read_csv(input_filename, usecols=columns).rename(columns={text_column: TEXT})
+    inputs = {
+        dependency: load_output(directory, STAGES[dependency].kind)
+        for dependency, directory in dependency_dirs.items()
+    }
+
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    result = stage.run(df, inputs, options, tmp_dir)
+    if stage.kind == "columns":
+        if len(result) != len(df):
+            raise RuntimeError(f"{name} returned {len(result)} rows for {len(df)} input rows")
+        result.to_csv(os.path.join(tmp_dir, "columns.csv"), index=False)
+    with open(os.path.join(tmp_dir, "options.json"), 'w') as f:
+        json.dump(options, f, indent=2, default=str)
+    open(os.path.join(tmp_dir, "DONE"), 'w').close()
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return time.perf_counter() - start
+
+
+def run_pipeline(
+        input_filename, output_dir, stages=DEFAULT_STAGES, config=None,
+        text_column=TEXT, max_parallel=2, force=(), dry_run=False
+    ):
+    """
+    Run `stages` (and the stages they depend on) over the articles of
+    `input_filename`, skipping stages with a cached output.
+
+    config: {stage: {option: value}} overriding `STAGES[stage].defaults`
+    text_column: column with the article text
+    max_parallel: stages run at the same time
+    force: stages to rerun even if cached
+    dry_run: only print what would run
+
+    Returns {stage: output directory} of the stages that succeeded; raises
+    RuntimeError after the other stages finish if any stage failed.
+    """
+    config = config or {}
+    for name in list(stages) + list(config):
+        if name not in STAGES:
+            raise ValueError(f"unknown stage {name!r}; choose from {', '.join(STAGES)}")
+    options = {}
+    for name, stage in STAGES.items():
+        unknown = set(config.get(name, {})) - set(stage.defaults)
+        if unknown:
+            raise ValueError(f"unknown options for {name}: {', '.join(sorted(unknown))}")
+        options[name] = dict(stage.defaults, **config.get(name, {}))
+
+    # the columns read by every stage that will be planned, dependencies included
+    planned = set()
+
+    def add_dependencies(name):
+        if name not in planned:
+            planned.add(name)
+            for dependency in STAGES[name].depends(options[name]):
+                add_dependencies(dependency)
+
+    for name in stages:
+        add_dependencies(name)
+    needed = {text_column}
+    for name in planned:
+        needed.update(STAGES[name].columns(options[name]))
+    df = pd.read_csv(input_filename, usecols=sorted(needed))
+    input_hashes = {TEXT if column == text_column else column: column_hash(df[column]) for column in needed}
+    del df
+
+    keys = plan(stages, options, input_hashes)
+    dirs = {name: output_dir_of(output_dir, name, key) for name, key in keys.items()}
+    todo = [name for name in keys if name in force or not is_done(dirs[name])]
+    for name in keys:
+        print(f"{name:>14}: {'run' if name in todo else 'cached'} ({dirs[name]})")
+    if dry_run:
+        return dirs
+
+    input_columns = {
+        name: [text_column] + [c for c in STAGES[name].columns(options[name]) if c != text_column]
+        for name in keys
+    }
+    done = {name: dirs[name] for name in keys if name not in todo}
+    failed = set()
+    running = {}
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_parallel, mp_context=context) as pool:
+        while todo or running:
+            for name in list(todo):
+                depends = STAGES[name].depends(options[name])
+                if any(d in failed for d in depends):
+                    print(f"{name}: skipped, a dependency failed")
+                    todo.remove(name)
+                    failed.add(name)
+                elif all(d in done for d in depends) and len(running) < max_parallel:
+                    todo.remove(name)
+                    future = pool.submit(
+                        run_stage, name, input_filename, input_columns[name], text_column, options[name],
+                        {d: dirs[d] for d in depends}, dirs[name]
+                    )
+                    running[future] = name
+                    print(f"{name}: started")
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    print(f"{name}: failed ({type(e).__name__}: {e})")
+                    failed.add(name)
+                else:
+                    print(f"{name}: done in {seconds:.1f}s")
+                    done[name] = dirs[name]
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_filename = os.path.join(output_dir, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename, 'r') as f:
+            manifest = json.load(f)
+    manifest.update({
+        name: {"key": keys[name], "kind": STAGES[name].kind, "path": path}
+        for name, path in done.items()
+    })
+    with open(manifest_filename + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_filename + ".tmp", manifest_filename)
+
+    if failed:
+        raise RuntimeError(f"stages failed: {', '.join(sorted(failed))}")
+    return done
+
+
+def merge_columns(input_filename, output_dir, out_filename=None, stages=None):
+    """
+    Join the column files of the stages in output_dir/manifest.json (or of
+    `stages`) onto the rows of `input_filename`; if provided, saves the result
+    to `out_filename`.
+    """
+    with open(os.path.join(output_dir, "manifest.json"), 'r') as f:
+        manifest = json.load(f)
+    df = pd.read_csv(input_filename)
+    for name, entry in manifest.items():
+        if entry["kind"] != "columns" or (stages is not None and name not in stages):
+            continue
+        columns = load_output(entry["path"], "columns")
+        if len(columns) != len(df):
+            raise ValueError(f"{name} output has {len(columns)} rows, {input_filename} has {len(df)}")
+        for column in columns.columns:
+            df[column] = columns[column].to_numpy()
+    if out_filename is not None:
+        df.to_csv(out_filename, index=False)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default="data/df-processed.csv")
+    parser.add_argument("--output-dir", default="data/pipeline")
+    parser.add_argument("--stages", default=",".join(DEFAULT_STAGES), help="comma-separated stages")
+    parser.add_argument("--config", help="JSON file with per-stage options")
+    parser.add_argument("--text-column", default=TEXT)
+    parser.add_argument("--max-parallel", type=int, default=2, help="stages run at the same time")
+    parser.add_argument("--force", default="", help="comma-separated stages to rerun even if cached")
+    parser.add_argument("--merge", help="also write the input with all column outputs to this CSV")
+    parser.add_argument("--dry-run", action="store_true", help="only show which stages would run")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    stages = [s for s in args.stages.split(",") if s]
+    force = [s for s in args.force.split(",") if s]
+    try:
+        done = run_pipeline(
+            args.input, args.output_dir, stages, config, args.text_column,
+            args.max_parallel, force, args.dry_run
+        )
+    except (ValueError, RuntimeError) as e:
+        sys.exit(str(e))
+    if args.merge and not args.dry_run:
+        merge_columns(args.input, args.output_dir, args.merge, stages=done)
+        print(f"Merged columns written to {args.merge}")
+
+
+if __name__ == '__main__':
+    main()
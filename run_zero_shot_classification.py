@@ -1,5 +1,13 @@
+import os
+import glob
+import argparse
+import multiprocessing
+import torch
+import numpy as np
 import pandas as pd
-from transformers import pipeline
+from transformers import pipeline, AutoTokenizer, AutoModelForSequenceClassification
+
+import metrics
 
 
 # labels for zero shot classification
@@ -25,41 +33,382 @@ topic_labels = ["This article is about " + l for l in topic_labels]
 
 
 
-def f_zero_shot_classification(df, labels, out_filename=None, *args, **kwargs):
+_classifiers = {}
+
+def load_classifier(model="facebook/bart-large-mnli", **kwargs):
+    """
+    Load the zero-shot-classification pipeline for `model` once per process
+    and share it across label sets; `kwargs` go to `pipeline` (default 
+    device_map="auto").
+    """
+    kwargs = kwargs or {"device_map": "auto"}
+    key = (model, tuple(sorted(kwargs.items())))
+    if key not in _classifiers:
+        # classifier = pipeline("zero-shot-classification", model="valhalla/distilbart-mnli-12-9", device=0)
+        with metrics.timer("zsc.model_load"):
+            _classifiers[key] = pipeline("zero-shot-classification", model=model, **kwargs)
+    return _classifiers[key]
+
+
+def label_column(label):
+    # df column name of a label
+    return "ZSC-" + label.replace("This article is about ", "").replace(" ", "-")
+
+
+def classify_texts(classifier, texts, labels, batch_size=8):
+    """
+    Score `texts` against `labels`, streaming them through `classifier` in 
+    batches of `batch_size`. Texts are sent shortest first so that each batch
+    holds similar lengths and little padding.
+
+    Returns a (len(texts), len(labels)) array; columns follow `labels`.
+    """
+    label_index = {label: k for k, label in enumerate(labels)}
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    scores = np.empty((len(texts), len(labels)))
+
+    results = classifier((texts[i] for i in order), labels, batch_size=batch_size, truncation=True)
+    with metrics.timer("zsc.inference"):
+        for i, result in zip(order, results):
+            # result["labels"] is sorted by score, not in the order of `labels`
+            for label, score in zip(result["labels"], result["scores"]):
+                scores[i, label_index[label]] = score
+            metrics.count("zsc.articles")
+    return scores
+
+
+def f_zero_shot_classification(df, labels, out_filename=None, *args, batch_size=8, classifier=None, **kwargs):
     """
     Given labels, perform zero-shot-classification for 
         the "Article Text" row in df; save results in df
 
     - `df` can be filenames or dataframes
     - if provided, will save output also to `out_filename`
+    - `classifier` defaults to the shared bart-large-mnli pipeline (`load_classifier()`)
     """
     if type(df) is str:
-        df = pd.read_csv(df)
+        with metrics.timer("zsc.read_csv"):
+            df = pd.read_csv(df)
     # os.environ["CUDA_VISIBLE_DEVICES"] = "0"
     # device = torch.device("cuda")
 
-    # classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
-    classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli", device_map="auto")
-    # classifier = pipeline("zero-shot-classification", model="valhalla/distilbart-mnli-12-9", device=0)
-
-    for index, row in df.iterrows():
-        text = str(row["Article Text"])
-        result = classifier(text, labels, truncation=True)
+    if classifier is None:
+        classifier = load_classifier()
 
-        for i, label in enumerate(labels):
+    texts = [str(text) for text in df["Article Text"]]
+    scores = classify_texts(classifier, texts, labels, batch_size)
+    with metrics.timer("zsc.df_write"):
+        for k, label in enumerate(labels):
             # df_label: column name in df
-            df_label = "ZSC-" + label.replace("This article is about ", "").replace(" ", "-")
-            df.loc[index, df_label] = result["scores"][i]
+            df[label_column(label)] = scores[:, k]
 
-    if df is not None:
-        df.to_csv(out_filename, index=False)
+    if out_filename is not None:
+        with metrics.timer("zsc.write_csv"):
+            df.to_csv(out_filename, index=False)
 
     return df
 
 
-if __name__ == '__main__':
-    f_zero_shot_classification("data/df-processed.csv", relevancy_labels, "data/df-processed.csv")
-    f_zero_shot_classification("data/df-processed.csv", topic_labels, "data/df-processed.csv")
+class ZeroShotEngine:
+    """
+    NLI zero-shot classifier that scores articles against several label sets
+    in one pass.
+
+    Same scores as the "zero-shot-classification" pipeline (single-label 
+    mode: softmax of the entailment logits over a label set), but each 
+    article is tokenized and truncated once and its token ids are reused for
+    every hypothesis of every label set; hypothesis encodings are cached too.
+    (premise, hypothesis) pairs are batched shortest first to reduce padding.
+    """
+
+    def __init__(self, model="facebook/bart-large-mnli", device=None, hypothesis_template="This example is {}."):
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        with metrics.timer("zsc.model_load"):
+            self.tokenizer = AutoTokenizer.from_pretrained(model)
+            self.model = AutoModelForSequenceClassification.from_pretrained(model).to(self.device).eval()
+        self.hypothesis_template = hypothesis_template
+        self.max_length = min(self.tokenizer.model_max_length, self.model.config.max_position_embeddings)
+        self.n_special = self.tokenizer.num_special_tokens_to_add(pair=True)
+
+        entailment = [i for label, i in self.model.config.label2id.items() if label.lower().startswith("entail")]
+        self.entailment_id = entailment[0] if entailment else -1
+        self._hypotheses = {}
+
+    def encode_premises(self, texts):
+        # token ids of each article (without special tokens), truncated once
+        return self.tokenizer(
+            list(texts), add_special_tokens=False, truncation=True, max_length=self.max_length
+        )["input_ids"]
+
+    def _hypothesis_ids(self, label):
+        if label not in self._hypotheses:
+            self._hypotheses[label] = self.tokenizer(
+                self.hypothesis_template.format(label), add_special_tokens=False
+            )["input_ids"]
+        return self._hypotheses[label]
+
+    @torch.inference_mode()
+    def score(self, premises, labels, batch_size=16):
+        """
+        premises: token ids from `encode_premises`
+        labels: one label set
+
+        Returns a (len(premises), len(labels)) array of scores.
+        """
+        pairs = []
+        for i, premise in enumerate(premises):
+            for k, label in enumerate(labels):
+                hypothesis = self._hypothesis_ids(label)
+                # truncate the premise so that the pair fits the model (per
+                # pair, as the pipeline does: the budget depends on the hypothesis)
+                truncated = premise[:self.max_length - self.n_special - len(hypothesis)]
+                pairs.append((i, k, self.tokenizer.build_inputs_with_special_tokens(truncated, hypothesis)))
+        pairs.sort(key=lambda pair: len(pair[2]))
+
+        logits = np.empty((len(premises), len(labels)))
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            inputs = self.tokenizer.pad({"input_ids": [ids for _, _, ids in batch]}, return_tensors="pt")
+            with metrics.timer("zsc.forward"):
+                outputs = self.model(**{k: v.to(self.device) for k, v in inputs.items()})
+            metrics.count("zsc.pairs", len(batch))
+            entailment = outputs.logits[:, self.entailment_id].float().cpu().numpy()
+            for (i, k, _), logit in zip(batch, entailment):
+                logits[i, k] = logit
+
+        # softmax over the label set, as in the pipeline with multi_label=False
+        logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return logits / logits.sum(axis=1, keepdims=True)
+
+
+def f_zero_shot_multi(
+        df, label_sets, out_filename=None, gate=None, engine=None, batch_size=16, chunk_size=256
+    ):
+    """
+    Zero-shot-classification of the "Article Text" row in df against several
+    label sets in one pass; save results in df (same "ZSC-" columns as 
+    `f_zero_shot_classification`)
+
+    - `df` can be filenames or dataframes
+    - `label_sets`: {name: labels}, e.g. {"relevancy": relevancy_labels, "topic": topic_labels}
+    - `gate`: optional (set name, label, threshold): articles scoring below 
+        `threshold` on `label` of that set are not scored on the other sets
+        (their columns are NaN), e.g. ("relevancy", relevancy_labels[0], 0.5)
+    - `engine`: a `ZeroShotEngine` to reuse; created if None
+    - articles are processed `chunk_size` at a time, so memory does not grow
+        with the number of articles
+    - if provided, will save output also to `out_filename`
+    """
+    if type(df) is str:
+        with metrics.timer("zsc.read_csv"):
+            df = pd.read_csv(df)
+    if engine is None:
+        engine = ZeroShotEngine()
+
+    texts = [str(text) for text in df["Article Text"]]
+    scores = {name: np.full((len(texts), len(labels)), np.nan) for name, labels in label_sets.items()}
+    names = list(label_sets)
+    if gate is not None:
+        # score the gate set first
+        names.remove(gate[0])
+        names.insert(0, gate[0])
+
+    for start in range(0, len(texts), chunk_size):
+        rows = np.arange(start, min(start + chunk_size, len(texts)))
+        with metrics.timer("zsc.tokenize"):
+            premises = engine.encode_premises(texts[i] for i in rows)
+        for name in names:
+            labels = label_sets[name]
+            with metrics.timer("zsc.inference"):
+                scores[name][rows] = engine.score(premises, labels, batch_size)
+            if gate is not None and name == gate[0]:
+                keep = scores[name][rows, labels.index(gate[1])] >= gate[2]
+                rows = rows[keep]
+                premises = [p for p, k in zip(premises, keep) if k]
+        metrics.count("zsc.articles", min(chunk_size, len(texts) - start))
+        print(f"Classified {min(start + chunk_size, len(texts))} / {len(texts)} articles")
+
+    with metrics.timer("zsc.df_write"):
+        for name, labels in label_sets.items():
+            for k, label in enumerate(labels):
+                df[label_column(label)] = scores[name][:, k]
 
+    if out_filename is not None:
+        with metrics.timer("zsc.write_csv"):
+            df.to_csv(out_filename, index=False)
 
+    return df
+
+
+def shard_rows(n_rows, shard_index, num_shards):
+    # deterministic sharding: row r belongs to shard r % num_shards
+    return np.arange(shard_index, n_rows, num_shards)
+
+
+def shard_dir(output_dir, shard_index, num_shards):
+    return os.path.join(output_dir, f"shard-{shard_index:04d}-of-{num_shards:04d}")
+
+
+def _done_rows(directory):
+    parts = glob.glob(os.path.join(directory, "part-*.csv"))
+    return set(np.concatenate([pd.read_csv(f, usecols=["row_id"])["row_id"].values for f in parts])) if parts else set()
+
+
+def run_shard(
+        in_filename, output_dir, shard_index, num_shards, label_sets, 
+        gate=None, checkpoint_every=256, batch_size=16, device=None, num_threads=None
+    ):
+    """
+    Classify one shard of `in_filename`, checkpointing every 
+    `checkpoint_every` articles.
+
+    Each checkpoint is written atomically as its own part file 
+    (output_dir/shard-XXXX-of-YYYY/part-<first row>.csv, columns row_id and 
+    the "ZSC-" columns); rows already in a part file are skipped, so a killed 
+    job resumes where it stopped. Use `merge_shards` to rebuild the frame.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    directory = shard_dir(output_dir, shard_index, num_shards)
+    os.makedirs(directory, exist_ok=True)
+
+    with metrics.timer("zsc.read_csv"):
+        texts = pd.read_csv(in_filename, usecols=["Article Text"])
+    done = _done_rows(directory)
+    rows = [r for r in shard_rows(len(texts), shard_index, num_shards) if r not in done]
+    print(f"Shard {shard_index}/{num_shards}: {len(rows)} rows to do, {len(done)} done")
+    if not rows:
+        return
+
+    engine = ZeroShotEngine(device=device)
+    for start in range(0, len(rows), checkpoint_every):
+        chunk = rows[start:start + checkpoint_every]
+        part = f_zero_shot_multi(
+            texts.iloc[chunk].reset_index(drop=True), label_sets, 
+            gate=gate, engine=engine, batch_size=batch_size, chunk_size=checkpoint_every
+        )
+        part = part.drop(columns=["Article Text"])
+        part.insert(0, "row_id", chunk)
+
+        filename = os.path.join(directory, f"part-{chunk[0]:09d}.csv")
+        with metrics.timer("zsc.write_csv"):
+            part.to_csv(filename + ".tmp", index=False)
+            os.replace(filename + ".tmp", filename)
+
+
+def merge_shards(in_filename, output_dir, out_filename=None):
+    """
+    Join the part files of all shards in `output_dir` back onto the rows of
+    `in_filename`; rows not classified yet get NaN. If provided, saves the 
+    result to `out_filename`.
+    """
+    df = pd.read_csv(in_filename)
+    parts = sorted(glob.glob(os.path.join(output_dir, "shard-*-of-*", "part-*.csv")))
+    if not parts:
+        raise FileNotFoundError(f"no shard output in {output_dir}")
+    results = pd.concat([pd.read_csv(f) for f in parts]).drop_duplicates("row_id", keep="last")
+    results = results.set_index("row_id").reindex(range(len(df)))
+
+    missing = results.isna().all(axis=1).sum()
+    if missing:
+        print(f"{missing} / {len(df)} rows have no results yet")
+    for column in results.columns:
+        df[column] = results[column].values
 
+    if out_filename is not None:
+        df.to_csv(out_filename, index=False)
+    return df
+
+
+def shard_metrics_options(options, shard_index):
+    # per-shard summary and profile files ("metrics-shard3.json"), unless 
+    # the names already hold "{pid}"
+    options = dict(options)
+    for key in ("summary_filename", "profile_filename"):
+        if options.get(key) and "{pid}" not in options[key]:
+            root, ext = os.path.splitext(options[key])
+            options[key] = f"{root}-shard{shard_index}{ext}"
+    return options
+
+
+def _run_shard_with_metrics(metrics_options, *args, **kwargs):
+    # a spawned worker starts with metrics off, and exits without running
+    # atexit hooks, so the summary is written here
+    metrics.enable(**metrics_options)
+    try:
+        run_shard(*args, **kwargs)
+    finally:
+        metrics.disable()
+
+
+def run_local(in_filename, output_dir, num_workers, label_sets, metrics_options=None, **kwargs):
+    """
+    Run `num_workers` shards as local CPU processes (same sharding as the 
+    SLURM array job), splitting the cores between them.
+
+    metrics_options: if set, `metrics.enable` arguments for the workers; 
+        each writes its own files (see `shard_metrics_options`)
+    """
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for i in range(num_workers):
+        target, args = run_shard, (in_filename, output_dir, i, num_workers, label_sets)
+        if metrics_options:
+            target, args = _run_shard_with_metrics, (shard_metrics_options(metrics_options, i),) + args
+        processes.append(context.Process(
+            target=target, args=args, kwargs=dict(kwargs, device="cpu", num_threads=num_threads)
+        ))
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    failed = [i for i, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"shards {failed} failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded, resumable zero-shot classification")
+    parser.add_argument("--input", default="data/df-processed.csv")
+    parser.add_argument("--output-dir", default="data/zsc-shards", help="shard checkpoints")
+    parser.add_argument("--output", default="data/df-processed.csv", help="merged output")
+    parser.add_argument("--shard-index", type=int, default=int(os.environ.get("SLURM_ARRAY_TASK_ID", 0)))
+    parser.add_argument("--num-shards", type=int, default=int(os.environ.get("SLURM_ARRAY_TASK_COUNT", 1)))
+    parser.add_argument("--local-workers", type=int, default=0, help="run this many shards as local CPU processes")
+    parser.add_argument("--merge", action="store_true", help="only merge existing shard outputs")
+    parser.add_argument("--checkpoint-every", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--gate", action="store_true", help="skip topic labels for irrelevant articles")
+    parser.add_argument("--metrics", help="write a timing/throughput summary (JSON) to this file")
+    parser.add_argument("--metrics-interval", type=float, default=300, help="seconds between progress lines")
+    parser.add_argument("--profile", help="write sampled stacks (collapsed format) to this file")
+    args = parser.parse_args()
+
+    metrics_options = None
+    if args.metrics or args.profile:
+        metrics_options = dict(
+            summary_filename=args.metrics, interval=args.metrics_interval, profile_filename=args.profile
+        )
+        metrics.enable(**metrics_options)
+
+    label_sets = {"relevancy": relevancy_labels, "topic": topic_labels}
+    kwargs = dict(
+        gate=("relevancy", relevancy_labels[0], 0.5) if args.gate else None,
+        checkpoint_every=args.checkpoint_every, 
+        batch_size=args.batch_size
+    )
+
+    if args.merge:
+        merge_shards(args.input, args.output_dir, args.output)
+    elif args.local_workers:
+        run_local(args.input, args.output_dir, args.local_workers, label_sets, metrics_options, **kwargs)
+        merge_shards(args.input, args.output_dir, args.output)
+    else:
+        run_shard(args.input, args.output_dir, args.shard_index, args.num_shards, label_sets, **kwargs)
+        if args.num_shards == 1:
+            merge_shards(args.input, args.output_dir, args.output)
+
+
+if __name__ == '__main__':
+    main()
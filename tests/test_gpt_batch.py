@@ -0,0 +1,89 @@
+import os
+import json
+import pandas as pd
+import pytest
+
+pytest.importorskip("openai")
+
+import gpt_batch
+from gpt_helper import topic_labels, sentiment_labels
+
+
+PROMPT_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gpt-prompt-combined")
+
+
+def respond(body):
+    return json.dumps({label: 0.5 for label in topic_labels + sentiment_labels})
+
+
+class CountingTransport(gpt_batch.LocalBatchTransport):
+    """Local transport that records submissions and can fail the n-th one."""
+
+    def __init__(self, fail_at=None):
+        super().__init__(respond, polls_until_done=0)
+        self.fail_at = fail_at
+        self.submitted = []
+
+    def submit(self, requests_filename):
+        if len(self.submitted) == self.fail_at:
+            self.fail_at = None
+            raise ConnectionError("submit failed")
+        self.submitted.append(gpt_batch.read_request_ids(requests_filename))
+        return super().submit(requests_filename)
+
+
+class ExpiringTransport(CountingTransport):
+    """Jobs expire without any output."""
+
+    def status(self, job_id):
+        return "expired"
+
+    def download(self, job_id, out_filename):
+        open(out_filename, 'w').close()
+
+
+def articles(n):
+    return pd.DataFrame({"Article Text": [f"Article number {i} about the school board." for i in range(n)]})
+
+
+def run(df, transport, workdir, **kwargs):
+    return gpt_batch.run_batch(df, transport, str(workdir), prompt_filename=PROMPT_FILENAME, poll_interval=0, **kwargs)
+
+
+def test_rows_added_after_submission_are_submitted(tmp_path):
+    transport = CountingTransport()
+    assert run(articles(2), transport, tmp_path)["GPT-valid"].all()
+    assert [len(ids) for ids in transport.submitted] == [2]
+
+    assert run(articles(3), transport, tmp_path)["GPT-valid"].all()
+    assert [len(ids) for ids in transport.submitted] == [2, 1]
+
+    # nothing new: nothing submitted
+    assert run(articles(3), transport, tmp_path)["GPT-valid"].all()
+    assert len(transport.submitted) == 2
+
+
+def test_crash_during_submission_does_not_resubmit_submitted_files(tmp_path):
+    transport = CountingTransport(fail_at=1)
+    with pytest.raises(ConnectionError):
+        run(articles(5), transport, tmp_path, max_requests=2)
+    assert len(gpt_batch.read_jobs(os.path.join(tmp_path, "jobs.json"))) == 1
+
+    assert run(articles(5), transport, tmp_path, max_requests=2)["GPT-valid"].all()
+    ids = [custom_id for batch in transport.submitted for custom_id in batch]
+    assert len(ids) == len(set(ids)) == 5
+
+
+def test_requests_of_expired_jobs_are_resubmitted(tmp_path):
+    expiring = ExpiringTransport()
+    assert not run(articles(2), expiring, tmp_path)["GPT-valid"].any()
+    assert not os.path.exists(os.path.join(tmp_path, "output-batch_local_0.jsonl"))
+
+    healthy = CountingTransport()
+    assert run(articles(2), healthy, tmp_path)["GPT-valid"].all()
+    assert [len(ids) for ids in healthy.submitted] == [2]
+    jobs = gpt_batch.read_jobs(os.path.join(tmp_path, "jobs.json"))
+    assert [job["status"] for job in jobs] == ["expired", "completed"]
+
+    # completed: nothing submitted or polled again
+    assert run(articles(2), CountingTransport(), tmp_path)["GPT-valid"].all()
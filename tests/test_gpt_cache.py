@@ -0,0 +1,72 @@
+import pytest
+
+import gpt_cache
+from gpt_cache import ResponseCache, CacheMiss
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(gpt_cache.time, "time", clock)
+    return clock
+
+
+def put(cache, prompt):
+    cache.put("model", "system", 0, prompt, {"prompt": prompt})
+
+
+def get(cache, prompt):
+    return cache.get("model", "system", 0, prompt)
+
+
+def test_max_age(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_age=60)
+    put(cache, "old")
+    clock.now += 50
+    put(cache, "new")
+    assert get(cache, "old") == {"prompt": "old"}
+
+    clock.now += 20
+    assert get(cache, "old") is None
+    assert get(cache, "new") == {"prompt": "new"}
+    cache.evict()
+    assert len(cache) == 1
+
+
+def test_max_entries_keeps_most_recently_used(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    for prompt in ("a", "b", "c"):
+        clock.now += 1
+        put(cache, prompt)
+    clock.now += 1
+    get(cache, "a")
+    cache.evict()
+    assert len(cache) == 2
+    assert get(cache, "b") is None
+    assert get(cache, "a") is not None and get(cache, "c") is not None
+
+
+def test_readonly_and_strict(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResponseCache(path)
+    put(cache, "a")
+    cache.close()
+
+    readonly = ResponseCache(path, readonly=True)
+    put(readonly, "b")
+    assert len(readonly) == 1
+    assert get(readonly, "a") == {"prompt": "a"}
+    assert get(readonly, "b") is None
+
+    strict = ResponseCache(path, readonly=True, strict=True)
+    assert get(strict, "a") == {"prompt": "a"}
+    with pytest.raises(CacheMiss):
+        get(strict, "b")
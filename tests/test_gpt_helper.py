@@ -0,0 +1,98 @@
+import os
+import json
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("openai")
+
+import gpt_helper
+from gpt_cache import ResponseCache
+from gpt_helper import topic_labels, sentiment_labels
+from mock_api import MockAPI, error
+
+
+PROMPT_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gpt-prompt-combined")
+
+
+class FakeAsyncClient:
+    """Stands in for `openai.AsyncOpenAI`: rates every label 0.5."""
+
+    def __init__(self, invalid_first=0):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.n_requests = 0
+        # the first `invalid_first` answers lack the sentiment labels
+        self.invalid_first = invalid_first
+
+    def with_options(self, **kwargs):
+        return self
+
+    async def create(self, **kwargs):
+        self.n_requests += 1
+        labels = topic_labels if self.n_requests <= self.invalid_first else topic_labels + sentiment_labels
+        content = json.dumps({label: 0.5 for label in labels})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+TEXTS = ["The board approved the budget.", "A new school opened.", "The board approved the budget."]
+
+
+def test_analyze_many():
+    client = FakeAsyncClient()
+    results = gpt_helper.analyze_many(TEXTS, prompt_filename=PROMPT_FILENAME, client=client)
+    assert all(gpt_helper.is_valid(r) for r in results)
+    assert client.n_requests == 2
+
+
+def test_analyze_many_async_in_running_loop():
+    async def notebook_cell():
+        client = FakeAsyncClient()
+        results = await gpt_helper.analyze_many_async(TEXTS, prompt_filename=PROMPT_FILENAME, client=client)
+        assert all(gpt_helper.is_valid(r) for r in results)
+
+        with pytest.raises(RuntimeError, match="analyze_many_async"):
+            gpt_helper.analyze_many(TEXTS, prompt_filename=PROMPT_FILENAME, client=client)
+
+    asyncio.run(notebook_cell())
+
+
+def test_retries_go_through_the_rate_limiters_only(monkeypatch):
+    monkeypatch.setattr(gpt_helper, "API_KEY", "test-key")
+    monkeypatch.setattr(gpt_helper, "backoff_delay", lambda attempt: 0)
+    with MockAPI(lambda request: (429, error("rate limited"))) as api:
+        with pytest.raises(gpt_helper.openai.RateLimitError):
+            gpt_helper.analyze_many(["x"], prompt_filename=PROMPT_FILENAME, base_url=api.base_url, max_retries=1)
+        # one request and one retry, none by the SDK
+        assert len(api.requests) == 2
+
+        client = gpt_helper.openai.AsyncOpenAI(api_key="test-key", base_url=api.base_url)
+        with pytest.raises(gpt_helper.openai.RateLimitError):
+            gpt_helper.analyze_many(["y"], prompt_filename=PROMPT_FILENAME, client=client, max_retries=1)
+        assert len(api.requests) == 4
+
+
+def test_only_valid_responses_are_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    kwargs = dict(prompt_filename=PROMPT_FILENAME, cache=cache)
+    first = gpt_helper.analyze_many(TEXTS[:2], client=FakeAsyncClient(invalid_first=1), **kwargs)
+    assert sum(gpt_helper.is_valid(r) for r in first) == 1
+
+    # the invalid answer is asked again, not replayed from the cache
+    client = FakeAsyncClient()
+    second = gpt_helper.analyze_many(TEXTS[:2], client=client, **kwargs)
+    assert all(gpt_helper.is_valid(r) for r in second)
+    assert client.n_requests == 1
+
+
+def test_invalid_packed_responses_are_not_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    kwargs = dict(prompt_filename=PROMPT_FILENAME, cache=cache, pack_size=2)
+    # the fake answers a packed prompt without the per-article keys, so both
+    # articles are re-sent alone
+    client = FakeAsyncClient()
+    assert all(gpt_helper.is_valid(r) for r in gpt_helper.analyze_many(TEXTS[:2], client=client, **kwargs))
+    assert client.n_requests == 3
+
+    client = FakeAsyncClient()
+    gpt_helper.analyze_many(TEXTS[:2], client=client, **kwargs)
+    assert client.n_requests == 1
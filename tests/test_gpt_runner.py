@@ -0,0 +1,92 @@
+import os
+import json
+import time
+import asyncio
+import pandas as pd
+import pytest
+
+pytest.importorskip("openai")
+
+import gpt_helper
+import gpt_runner
+from gpt_helper import topic_labels, sentiment_labels
+from mock_api import MockAPI, completion, error
+
+
+PROMPT_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gpt-prompt-combined")
+
+
+class Server:
+    """
+    Answers by article: "bad" gets a 400, "invalid" an answer failing 
+    `check()`, "flaky" a 503 while `outage` is set; the rest valid answers.
+    """
+
+    def __init__(self):
+        self.outage = True
+
+    def __call__(self, request):
+        prompt = request["messages"][-1]["content"]
+        if "bad" in prompt:
+            return 400, error("bad request")
+        if "flaky" in prompt and self.outage:
+            return 503, error("overloaded")
+        labels = topic_labels if "invalid" in prompt else topic_labels + sentiment_labels
+        return 200, completion(json.dumps({label: 0.5 for label in labels}))
+
+
+def read_jsonl(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resume_tail_repair_and_dead_letters(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpt_helper, "API_KEY", "test-key")
+    monkeypatch.setattr(gpt_helper, "backoff_delay", lambda attempt: 0)
+    in_filename, out_filename = str(tmp_path / "in.csv"), str(tmp_path / "out.jsonl")
+    texts = ["article ok one", "article bad", "article flaky", "article invalid", "article ok two"]
+    pd.DataFrame({"Article Text": texts}).to_csv(in_filename, index=False)
+    kwargs = dict(prompt_filename=PROMPT_FILENAME, chunksize=2, max_attempts=2, max_retries=0)
+
+    server = Server()
+    with MockAPI(server) as api:
+        assert gpt_runner.run_dataset(in_filename, out_filename, base_url=api.base_url, **kwargs) == (2, 2)
+        dead = {record["row_id"]: record["error"] for record in read_jsonl(str(tmp_path / "out.dead.jsonl"))}
+        assert dead[3] == "check failed" and dead[1].startswith("BadRequestError")
+        # the 503 is not a final answer
+        assert 2 not in dead
+
+        # a crash in the middle of a write
+        with open(out_filename, 'a') as f:
+            f.write('{"row_id": 4, "Educ')
+        server.outage = False
+        n_requests = len(api.requests)
+        assert gpt_runner.run_dataset(in_filename, out_filename, base_url=api.base_url, **kwargs) == (1, 0)
+        # only the flaky row was asked again
+        assert len(api.requests) == n_requests + 1
+
+    results = gpt_runner.load_results(out_filename)
+    assert sorted(results.index) == [0, 2, 4]
+
+
+def test_chunks_share_one_pair_of_rate_limiters(tmp_path, monkeypatch):
+    seen = []
+
+    def analyze_many(texts, *args, limiters=None, **kwargs):
+        seen.append(limiters)
+        return [{label: 0.5 for label in topic_labels + sentiment_labels} for _ in texts]
+
+    monkeypatch.setattr(gpt_helper, "analyze_many", analyze_many)
+    in_filename = str(tmp_path / "in.csv")
+    pd.DataFrame({"Article Text": [f"article {i}" for i in range(5)]}).to_csv(in_filename, index=False)
+    assert gpt_runner.run_dataset(in_filename, str(tmp_path / "out.jsonl"), chunksize=2) == (5, 0)
+    assert len(seen) == 3 and seen[0] is not None and all(limiters is seen[0] for limiters in seen)
+
+
+def test_token_bucket_budget_carries_over_event_loops():
+    bucket = gpt_helper.TokenBucket(6000)
+    asyncio.run(bucket.acquire(6000))
+    start = time.monotonic()
+    # empty after the first loop: 50 tokens take 0.5s at 100/s
+    asyncio.run(bucket.acquire(50))
+    assert time.monotonic() - start >= 0.4
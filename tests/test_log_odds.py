@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import log_odds_ratio
+
+
+def bootstrap_corpora(seed=0):
+    # "budget" is 5x more frequent in corpus i; every document of corpus i
+    # also has its own word ("only<k>") that min_count filters out
+    rng = np.random.default_rng(seed)
+    common = [f"w{k}" for k in range(200)]
+
+    def document(extra):
+        return " ".join(list(rng.choice(common, 100)) + extra)
+
+    corpus_i = [document(["budget"] * 10 + [f"only{k}"] * 300) for k in range(40)]
+    corpus_j = [document(["budget"] * 2) for _ in range(40)]
+    return corpus_i, corpus_j
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_bootstrap_ranks_within_min_count_words(n_jobs):
+    corpus_i, corpus_j = bootstrap_corpora()
+    df = log_odds_ratio.bootstrap_log_odds(corpus_i, corpus_j, n_boot=100, top_n=10, n_jobs=n_jobs, min_count=5)
+    assert not df.index.str.startswith("only").any()
+    budget = df.loc["budget"]
+    assert budget["rank"] == 1
+    assert budget["median_rank"] == 1
+    assert budget["top_n_frac"] == pytest.approx(1, abs=0.05)
+
+
+CORPUS_I = [
+    "the board approved the budget",
+    "the budget vote was delayed again",
+    "parents asked the board about safety",
+]
+CORPUS_J = [
+    "the superintendent visited the new school",
+    "the school board discussed safety and the budget",
+    "students returned to school",
+]
+BACKGROUND = CORPUS_I + CORPUS_J + ["the district published the budget report"]
+
+
+@pytest.mark.parametrize("background", [None, BACKGROUND])
+@pytest.mark.parametrize("min_count", [0, 2])
+def test_numpy_engine_matches_python_engine(background, min_count):
+    python = log_odds_ratio.main(CORPUS_I, CORPUS_J, background, engine="python", min_count=min_count)
+    numpy = log_odds_ratio.main(CORPUS_I, CORPUS_J, background, engine="numpy", min_count=min_count)
+    assert len(numpy) > 0
+    assert sorted(numpy.index) == sorted(python.index)
+    python = python.loc[numpy.index]
+    for column in ("z_score", "count1", "count2", "total_count"):
+        assert np.allclose(numpy[column].astype(float), python[column].astype(float))
+
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_background_missing_words_raises(engine):
+    # "approved" occurs only in corpus i and not in the background corpus
+    background = ["the board discussed the budget"]
+    with pytest.raises(ValueError):
+        log_odds_ratio.main(CORPUS_I, CORPUS_J, background, engine=engine)
+
+
+GROUPS = ["a", "a", "b", "b", "c", "c"]
+
+
+@pytest.mark.parametrize("min_count", [0, 2])
+def test_group_log_odds_matches_python_engine(min_count):
+    corpus = CORPUS_I + CORPUS_J
+    df = log_odds_ratio.group_log_odds(corpus, GROUPS, min_count=min_count, pairwise=True)
+
+    names = sorted(set(GROUPS))
+    comparisons = [(g, "rest") for g in names]
+    comparisons += [(g, h) for k, g in enumerate(names) for h in names[k + 1:]]
+    assert set(zip(df["group"], df["other"])) == set(comparisons)
+    for g, h in comparisons:
+        docs_i = [d for d, group in zip(corpus, GROUPS) if group == g]
+        docs_j = [d for d, group in zip(corpus, GROUPS) if group != g and h in ("rest", group)]
+        expected = log_odds_ratio.main(docs_i, docs_j, engine="python", min_count=min_count)
+        result = df[(df["group"] == g) & (df["other"] == h)].set_index("word")
+        assert sorted(result.index) == sorted(expected.index)
+        expected = expected.loc[result.index]
+        for column in ("z_score", "count1", "count2", "total_count"):
+            assert np.allclose(result[column].astype(float), expected[column].astype(float))
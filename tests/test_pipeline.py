@@ -0,0 +1,38 @@
+import os
+import json
+import pandas as pd
+import pytest
+
+import pipeline
+from mock_api import MockAPI, error
+
+
+@pytest.mark.parametrize("status, message", [(400, "2 / 2 requests failed"), (401, "AuthenticationError")])
+def test_gpt_stage_with_failing_transport_is_not_cached(tmp_path, monkeypatch, capsys, status, message):
+    pytest.importorskip("openai")
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    input_filename = tmp_path / "input.csv"
+    pd.DataFrame({"Article Text": ["The board met.", "The budget passed."]}).to_csv(input_filename, index=False)
+    with MockAPI(lambda request: (status, error())) as api:
+        config = {"gpt": {"base_url": api.base_url, "cache": None}}
+        with pytest.raises(RuntimeError, match="stages failed: gpt"):
+            pipeline.run_pipeline(str(input_filename), str(tmp_path / "out"), ["gpt"], config, max_parallel=1)
+    assert message in capsys.readouterr().out
+
+    stage_dir = tmp_path / "out" / "gpt"
+    assert not any(pipeline.is_done(os.path.join(stage_dir, key)) for key in os.listdir(stage_dir))
+    with open(tmp_path / "out" / "manifest.json") as f:
+        assert "gpt" not in json.load(f)
+
+
+def test_dependency_columns_are_read_when_only_downstream_stage_is_asked(tmp_path, monkeypatch):
+    input_filename = tmp_path / "input.csv"
+    pd.DataFrame({"Article Text": ["a", "b"], "District": ["x", "y"]}).to_csv(input_filename, index=False)
+    monkeypatch.setitem(pipeline.STAGES, "grouped", pipeline.Stage(
+        None, "columns", {}, columns=lambda options: ("District",)
+    ))
+    monkeypatch.setitem(pipeline.STAGES, "downstream", pipeline.Stage(
+        None, "columns", {}, depends=lambda options: ("grouped",)
+    ))
+    dirs = pipeline.run_pipeline(str(input_filename), str(tmp_path / "out"), ["downstream"], dry_run=True)
+    assert list(dirs) == ["grouped", "downstream"]
@@ -0,0 +1,59 @@
+import pytest
+
+pytest.importorskip("gensim")
+try:
+    import word2vec_main
+except LookupError:
+    pytest.skip("NLTK stopwords not installed", allow_module_level=True)
+
+
+@pytest.fixture
+def split_sentences(monkeypatch):
+    # no punkt needed: sentences end with ". "
+    monkeypatch.setattr(word2vec_main.nltk, "sent_tokenize", lambda text: text.split(". "))
+
+
+def read(corpus):
+    return [" ".join(words) for words in corpus]
+
+
+def test_sentence_cache_is_rebuilt_for_other_texts(tmp_path, split_sentences):
+    filename = str(tmp_path / "sentences.txt")
+    first = read(word2vec_main.SentenceCorpus(["The board met. It voted."], filename))
+    assert first == ["the board met", "it voted"]
+
+    # same texts: the cache is reused, even if it was changed since
+    with open(filename, 'a') as f:
+        f.write("cached\n")
+    assert read(word2vec_main.SentenceCorpus(["The board met. It voted."], filename)) == first + ["cached"]
+
+    assert read(word2vec_main.SentenceCorpus(["A new budget."], filename)) == ["a new budget"]
+    # a generator can't be checked, so it is always rebuilt
+    assert read(word2vec_main.SentenceCorpus(iter(["Other news."]), filename)) == ["other news"]
+
+
+def test_sentence_cache_streams_later_passes(tmp_path, split_sentences):
+    corpus = word2vec_main.SentenceCorpus(iter(["The board met. It voted."]), str(tmp_path / "sentences.txt"))
+    assert read(corpus) == read(corpus) == ["the board met", "it voted"]
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "   \t\n ",
+    "Hello, World!",
+    "See https://example.com/a?b=c and www.district.org or news.com/story today",
+    "Call 555 1234 in 2024, room 12b or 3rd floor",
+    "Wait... what?! -- no---way (really) [sic] {ok}",
+    "don't won’t “quoted” ‘single’",
+    "Café naïve résumé Straße ÉCOLE",
+    "tab\tnew\nline\r\nnbsp\xa0em space sep",
+    "soft\xadhyphen – en — em ◾ ® © ✓ ▲ ◄ ▼ ► • ■ … ~ |",
+    "emoji 🎉 and 中文 mixed with ascii",
+    "under_score back`tick star*s a.b.c",
+    "١٢٣ arabic digits ² superscript",
+])
+@pytest.mark.parametrize("remove_numeric", [True, False])
+def test_clean_text_fast_matches_clean_text(text, remove_numeric):
+    expected = word2vec_main.clean_text(text, remove_numeric)
+    assert word2vec_main.clean_text_fast(text, remove_numeric) == expected
+    assert list(word2vec_main.clean_texts([text], remove_numeric=remove_numeric)) == [expected]
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("gensim")
+from gensim.models import KeyedVectors
+
+import word2vec_get_closest as closest
+
+
+WORDS = [f"word{i}" for i in range(300)]
+
+
+def make_models(word2vec_dir, seed, n_models=3, dim=20):
+    # random vectors saved as .wv files, as in `benchmark._make_models`
+    os.makedirs(word2vec_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for k in range(n_models):
+        kv = KeyedVectors(dim)
+        kv.add_vectors(WORDS, rng.standard_normal((len(WORDS), dim)).astype(np.float32))
+        filename = os.path.join(word2vec_dir, f"{k}.wv")
+        kv.save(filename)
+        # a later mtime even within the file system's time resolution
+        os.utime(filename, (seed + 1e9, seed + 1e9))
+    return closest.get_models(closest.find_model_files(word2vec_dir))
+
+
+def expected(models, queries, n):
+    result = closest.get_closest(queries, models, WORDS, dict(enumerate(WORDS)), n)
+    return [w for w, _ in result], np.array([d for _, d in result])
+
+
+QUERIES = [["word0", "word1"], ["word7"], ["word42", "word100", "word299"]]
+
+
+def test_query_matches_get_closest(tmp_path):
+    models = make_models(str(tmp_path / "wv"), seed=0)
+    index = closest.EnsembleIndex.load_or_build(str(tmp_path / "wv"))
+    for queries, df in zip(QUERIES, index.query(QUERIES, n=15)):
+        words, scores = expected(models, queries, 15)
+        assert list(df.index) == words
+        assert np.allclose(df["d"], scores, atol=1e-5)
+
+
+@pytest.mark.parametrize("approximate", [False, True])
+def test_main_reloads_after_retraining(tmp_path, approximate):
+    word2vec_dir = str(tmp_path / "wv")
+    kwargs = dict(n=10, approximate=approximate, n_probe=1000)
+    make_models(word2vec_dir, seed=0)
+    closest.main(QUERIES[0], word2vec_dir, **kwargs)
+
+    models = make_models(word2vec_dir, seed=1)
+    df = closest.main(QUERIES[0], word2vec_dir, **kwargs)
+    words, scores = expected(models, QUERIES[0], 10)
+    assert list(df.index) == words
+    assert np.allclose(df["d"], scores, atol=1e-5)
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import run_zero_shot_classification as zsc
+
+
+MODEL = os.environ.get("ZSC_TEST_MODEL", "facebook/bart-large-mnli")
+
+
+@pytest.fixture(scope="module")
+def models():
+    try:
+        engine = zsc.ZeroShotEngine(MODEL, device="cpu")
+        classifier = zsc.load_classifier(MODEL, device="cpu")
+    except OSError as e:
+        pytest.skip(f"model {MODEL} not available: {e}")
+    return engine, classifier
+
+
+def test_engine_matches_pipeline_on_truncated_articles(models):
+    engine, classifier = models
+    # hypotheses of different lengths, longest first, so that a premise
+    # truncated for one label would be too short for the next
+    labels = [
+        "This article is about the budget of the school district and its funding by the state",
+        "This article is about school safety",
+        "This is sports",
+    ]
+    sentence = "The superintendent presented the new budget to the school board on Tuesday. "
+    texts = [sentence * 200, "The board met on Monday."]
+    assert len(engine.encode_premises(texts[:1])[0]) >= engine.max_length
+
+    premises = engine.encode_premises(texts)
+    scores = engine.score(premises, labels)
+    expected = zsc.classify_texts(classifier, texts, labels)
+    # the engine's default template is the pipeline's too
+    assert np.allclose(scores, expected, atol=1e-4)
+
+
+def test_local_workers_write_their_own_metrics(tmp_path):
+    import json
+    import pandas as pd
+
+    in_filename = str(tmp_path / "articles.csv")
+    pd.DataFrame({"Article Text": []}).to_csv(in_filename, index=False)
+    options = dict(summary_filename=str(tmp_path / "metrics.json"), interval=300)
+    zsc.run_local(in_filename, str(tmp_path / "shards"), 2, {}, metrics_options=options)
+
+    assert not os.path.exists(options["summary_filename"])
+    for i in range(2):
+        with open(tmp_path / f"metrics-shard{i}.json") as f:
+            summary = json.load(f)
+        assert summary["histograms"]["zsc.read_csv"]["count"] == 1
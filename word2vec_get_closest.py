@@ -1,5 +1,7 @@
 import argparse
 import os
+import json
+import codecs
 import numpy as np
 import pandas as pd
 from gensim.models import KeyedVectors
@@ -17,40 +19,269 @@ def get_closest(queries, models, vocab, idx2word, n=15):
     # return [(idx2word[idx], cosines[idx]) for idx in cosines.argsort()[-20:][::-1]]
     return [(idx2word[idx], cosines[idx]) for idx in cosines.argsort()[-n:][::-1]]
 
-def main(queries, word2vec_dir="data/wv", n=15):
-    # print("Loading models...")
+def find_model_files(word2vec_dir):
     filelist = []
     for subdir, dirs, files in os.walk(word2vec_dir):
         for file in files:
             filelist.append(os.path.join(subdir, file))
-    models = get_models(filelist)
+    return sorted(f for f in filelist if f.endswith('.wv'))
 
-    # Get vocab
-    vocab = set(models[0].key_to_index)
-    for m in models:
-        vocab &= set(m.key_to_index)
 
-    # Remove queries not in vocab
-    queries = set(queries)
-    not_in_vocab = queries - vocab
-    if not_in_vocab:
-        print("Not in vocab:", not_in_vocab)
-    queries = list(queries - not_in_vocab)
-    vocab = list(vocab)
-    idx2word = {i: w for i, w in enumerate(vocab)}
+def _fingerprint(model_files):
+    return [[f, os.path.getmtime(f), os.path.getsize(f)] for f in model_files]
+
+
+class EnsembleIndex:
+    """
+    Nearest neighbours by cosine similarity averaged over an ensemble of 
+    word2vec models (the same ranking as `get_closest`).
+
+    The models are aligned to their shared vocabulary and stored as one 
+    float32 array `vectors` of shape (n_words, n_models * dim): row w is the
+    concatenation of the L2-normalized vectors of w in every model. The 
+    averaged cosine of word w with query set Q is then
+
+        vectors[w] @ mean(vectors[Q]) / n_models
+
+    so a batch of query sets is answered with one matrix multiply and 
+    `argpartition` top-n. The array is saved as .npy in `index_dir` and 
+    memory-mapped when loaded.
+    """
+
+    def __init__(self, words, vectors, n_models, index_dir=None):
+        self.words = words
+        self.word2id = {w: i for i, w in enumerate(words)}
+        self.vectors = vectors
+        self.n_models = n_models
+        self.index_dir = index_dir
+
+    @classmethod
+    def build(cls, word2vec_dir="data/wv", index_dir=None):
+        index_dir = index_dir or os.path.join(word2vec_dir, "index")
+        os.makedirs(index_dir, exist_ok=True)
+        model_files = find_model_files(word2vec_dir)
+        models = get_models(model_files)
+
+        # shared vocab, in the first model's (frequency) order
+        vocab = set(models[0].key_to_index)
+        for m in models:
+            vocab &= set(m.key_to_index)
+        words = [w for w in models[0].index_to_key if w in vocab]
+
+        dim = models[0].vector_size
+        # written next to the old file and swapped in, so that an index 
+        # still mapping the old one keeps reading it
+        vectors = np.lib.format.open_memmap(
+            os.path.join(index_dir, "vectors.tmp.npy"), mode='w+', 
+            dtype=np.float32, shape=(len(words), len(models) * dim)
+        )
+        for k, m in enumerate(models):
+            v = m.vectors[[m.key_to_index[w] for w in words]].astype(np.float32)
+            v /= np.linalg.norm(v, axis=1, keepdims=True)
+            vectors[:, k * dim:(k + 1) * dim] = v
+        vectors.flush()
+        del vectors
+        os.replace(os.path.join(index_dir, "vectors.tmp.npy"), os.path.join(index_dir, "vectors.npy"))
+
+        with codecs.open(os.path.join(index_dir, "words.txt"), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(words))
+        with open(os.path.join(index_dir, "meta.json"), 'w') as f:
+            json.dump({"n_models": len(models), "dim": dim, "models": _fingerprint(model_files)}, f)
+        return cls.load(index_dir)
+
+    @classmethod
+    def load(cls, index_dir):
+        with codecs.open(os.path.join(index_dir, "words.txt"), 'r', encoding='utf-8') as f:
+            words = f.read().split('\n')
+        with open(os.path.join(index_dir, "meta.json"), 'r') as f:
+            meta = json.load(f)
+        vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode='r')
+        return cls(words, vectors, meta["n_models"], index_dir)
+
+    @classmethod
+    def load_or_build(cls, word2vec_dir="data/wv", index_dir=None):
+        """Load the index, (re)building it if the .wv files changed since it was built."""
+        index_dir = index_dir or os.path.join(word2vec_dir, "index")
+        meta_filename = os.path.join(index_dir, "meta.json")
+        if os.path.exists(meta_filename):
+            with open(meta_filename, 'r') as f:
+                meta = json.load(f)
+            if meta["models"] == _fingerprint(find_model_files(word2vec_dir)):
+                return cls.load(index_dir)
+        return cls.build(word2vec_dir, index_dir)
+
+    def query_vectors(self, query_sets):
+        """
+        Mean concatenated vector of each query set (words not in the vocab 
+        are dropped), and whether any query word was in the vocab.
+        """
+        Q = np.zeros((len(query_sets), self.vectors.shape[1]), dtype=np.float32)
+        found = np.zeros(len(query_sets), dtype=bool)
+        for b, queries in enumerate(query_sets):
+            not_in_vocab = {q for q in queries if q not in self.word2id}
+            if not_in_vocab:
+                print("Not in vocab:", not_in_vocab)
+            ids = [self.word2id[q] for q in set(queries) - not_in_vocab]
+            if ids:
+                Q[b] = self.vectors[ids].mean(axis=0)
+                found[b] = True
+        return Q, found
+
+    def query(self, query_sets, n=15):
+        """
+        Top `n` words by averaged cosine for each query set in `query_sets`.
+
+        Returns one DataFrame per query set, as `main()`.
+        """
+        n = min(n, len(self.words))
+        Q, found = self.query_vectors(query_sets)
+        scores = self.vectors @ (Q.T / self.n_models)
+        ret = []
+        for b in range(len(query_sets)):
+            top = np.argpartition(-scores[:, b], n - 1)[:n] if found[b] and n > 0 else np.zeros(0, dtype=int)
+            top = top[np.argsort(-scores[top, b], kind="stable")]
+            df = pd.DataFrame({"word": [self.words[i] for i in top], "d": scores[top, b]}).set_index("word")
+            df.index.name = None
+            ret.append(df)
+        return ret
+
+
+class ApproxEnsembleIndex:
+    """
+    Approximate nearest neighbours for an `EnsembleIndex` (inverted file).
+
+    Rows of the ensemble array are projected to `n_components` dimensions 
+    with a random Gaussian matrix (which approximately preserves inner 
+    products) and partitioned by spherical k-means into `n_lists` clusters.
+    A query scores the centroids in the projected space, takes the words of
+    the `n_probe` best clusters as candidates and re-ranks them exactly with
+    the full ensemble vectors, so returned scores equal the averaged cosine 
+    of `get_closest` and the ranking matches it whenever the true top n are
+    among the candidates (see `recall_at_n`).
+
+    Saved next to the exact index (ann-*.npy) and memory-mapped when loaded.
+    """
+
+    def __init__(self, index, projection, centroids, list_ids, list_offsets):
+        self.index = index
+        self.projection = projection
+        self.centroids = centroids
+        self.list_ids = list_ids
+        self.list_offsets = list_offsets
+
+    @staticmethod
+    def _project(index, projection, batch_size=8192):
+        projected = np.empty((len(index.words), projection.shape[1]), dtype=np.float32)
+        for start in range(0, len(projected), batch_size):
+            projected[start:start + batch_size] = index.vectors[start:start + batch_size] @ projection
+        projected /= np.linalg.norm(projected, axis=1, keepdims=True) + 1e-12
+        return projected
+
+    @staticmethod
+    def _assign(points, centroids, batch_size=8192):
+        return np.concatenate([
+            np.argmax(points[start:start + batch_size] @ centroids.T, axis=1)
+            for start in range(0, len(points), batch_size)
+        ]) if len(points) else np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def build(cls, index, n_lists=None, n_components=256, n_iter=10, sample_size=100000, seed=0):
+        rng = np.random.default_rng(seed)
+        n_words, full_dim = index.vectors.shape
+        n_lists = n_lists or max(1, int(2 * np.sqrt(n_words)))
+        n_lists = min(n_lists, n_words)
+        n_components = min(n_components, full_dim)
+
+        projection = (rng.standard_normal((full_dim, n_components)) / np.sqrt(n_components)).astype(np.float32)
+        projected = cls._project(index, projection)
+
+        # spherical k-means on a sample of the rows
+        sample = projected[rng.choice(n_words, min(sample_size, n_words), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignment = cls._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            sums[empty] = sample[rng.choice(len(sample), empty.sum())]
+            centroids = sums / (np.linalg.norm(sums, axis=1, keepdims=True) + 1e-12)
+
+        assignment = cls._assign(projected, centroids)
+        list_ids = np.argsort(assignment, kind="stable").astype(np.int64)
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))]).astype(np.int64)
+
+        for name, array in (("projection", projection), ("centroids", centroids), 
+                            ("list_ids", list_ids), ("list_offsets", list_offsets)):
+            np.save(os.path.join(index.index_dir, f"ann-{name}.tmp.npy"), array)
+            os.replace(os.path.join(index.index_dir, f"ann-{name}.tmp.npy"), os.path.join(index.index_dir, f"ann-{name}.npy"))
+        with open(os.path.join(index.index_dir, "meta.json"), 'r') as f:
+            fingerprint = json.load(f)["models"]
+        with open(os.path.join(index.index_dir, "ann-meta.json"), 'w') as f:
+            json.dump({"n_lists": n_lists, "n_components": n_components, "models": fingerprint}, f)
+        return cls.load(index)
+
+    @classmethod
+    def load(cls, index):
+        arrays = [
+            np.load(os.path.join(index.index_dir, f"ann-{name}.npy"), mmap_mode='r')
+            for name in ("projection", "centroids", "list_ids", "list_offsets")
+        ]
+        return cls(index, *arrays)
+
+    @classmethod
+    def load_or_build(cls, word2vec_dir="data/wv", index_dir=None, **kwargs):
+        """Load the ANN index, (re)building it (and the exact index) if the .wv files changed."""
+        index = EnsembleIndex.load_or_build(word2vec_dir, index_dir)
+        meta_filename = os.path.join(index.index_dir, "ann-meta.json")
+        if os.path.exists(meta_filename):
+            with open(meta_filename, 'r') as f:
+                ann_fingerprint = json.load(f)["models"]
+            with open(os.path.join(index.index_dir, "meta.json"), 'r') as f:
+                if json.load(f)["models"] == ann_fingerprint:
+                    return cls.load(index)
+        return cls.build(index, **kwargs)
+
+    def query(self, query_sets, n=15, n_probe=16):
+        """Approximate `EnsembleIndex.query`: exact scores over the words of the `n_probe` best clusters."""
+        index = self.index
+        Q, found = index.query_vectors(query_sets)
+        probes = np.argsort(-(Q @ self.projection) @ self.centroids.T, axis=1)[:, :n_probe]
+        ret = []
+        for b in range(len(query_sets)):
+            candidates = np.concatenate([
+                self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes[b]
+            ])
+            candidates.sort()
+            scores = index.vectors[candidates] @ (Q[b] / index.n_models)
+            k = min(n, len(candidates)) if found[b] else 0
+            top = np.argpartition(-scores, k - 1)[:k] if k else np.zeros(0, dtype=int)
+            top = top[np.argsort(-scores[top], kind="stable")]
+            df = pd.DataFrame({"word": [index.words[i] for i in candidates[top]], "d": scores[top]}).set_index("word")
+            df.index.name = None
+            ret.append(df)
+        return ret
 
-    # print("Getting most similar words...")
-    closest = get_closest(queries, models, vocab, idx2word, n)
+    def recall_at_n(self, query_sets, n=15, n_probe=16):
+        """Mean fraction of the exact top `n` words that the approximate search returns."""
+        exact = self.index.query(query_sets, n)
+        approx = self.query(query_sets, n, n_probe)
+        recalls = [len(set(e.index) & set(a.index)) / len(e) for e, a in zip(exact, approx) if len(e)]
+        return float(np.mean(recalls)) if recalls else float("nan")
 
-    ret_w = []
-    ret_c = []
-    for (w, c) in closest:
-        # print("%s %.2f" % (w, c))
-        ret_w.append(w)
-        ret_c.append(c)
 
-    ret = pd.DataFrame({"word": ret_w, "d": ret_c}).set_index("word")
-    ret.index.name = None
-    return ret
+# word2vec_dir -> (fingerprint of its .wv files, index)
+_indexes = {}
+_approx_indexes = {}
 
+def _cached_index(cache, cls, word2vec_dir):
+    # kept for later queries, but reloaded (or rebuilt) when the .wv files
+    # change, e.g. after retraining in the same session
+    fingerprint = _fingerprint(find_model_files(word2vec_dir))
+    if word2vec_dir not in cache or cache[word2vec_dir][0] != fingerprint:
+        cache[word2vec_dir] = (fingerprint, cls.load_or_build(word2vec_dir))
+    return cache[word2vec_dir][1]
 
+def main(queries, word2vec_dir="data/wv", n=15, approximate=False, n_probe=16):
+    if approximate:
+        return _cached_index(_approx_indexes, ApproxEnsembleIndex, word2vec_dir).query([queries], n, n_probe)[0]
+    return _cached_index(_indexes, EnsembleIndex, word2vec_dir).query([queries], n)[0]
@@ -2,12 +2,19 @@ from gensim.models import phrases, word2vec
 import nltk
 import numpy as np
 import codecs
-from collections import Counter
+import json
+import array
+import hashlib
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from nltk.corpus import stopwords
 import os
 import re
 import string
 
+import metrics
+
 punct_chars = list((set(string.punctuation) | {'»', '–', '—', '-',"­", '\xad', '-', '◾', '®', '©','✓','▲', '◄','▼','►', '~', '|', '“', '”', '…', "'", "`", '_', '•', '*', '■'} - {"'"}))
 punct_chars.sort()
 punctuation = ''.join(punct_chars)
@@ -43,48 +50,328 @@ def clean_text(text, remove_numeric=True):
     return words
 
 
-def main(texts, output_dir="data/wv", bootstrap=True, num_runs=50, dim=100, window=5):
+url_pattern = re.compile(r'http\S*|\S*\.com\S*|\S*www\S*')
+
+
+class _CleanTable(dict):
+    """
+    `str.translate` table doing the character-level steps of `clean_text` 
+    in one pass: punctuation and whitespace (`\\s`, i.e. `str.isspace`) 
+    become a space and other non-printable characters are dropped. Entries 
+    are filled in on first use of each code point.
+    """
+
+    def __missing__(self, code):
+        c = chr(code)
+        if c in punct_chars or c.isspace():
+            value = ' '
+        elif c in printable:
+            value = c
+        else:
+            value = None
+        self[code] = value
+        return value
+
+_clean_table = _CleanTable()
+
+
+def clean_text_fast(text, remove_numeric=True):
+    """
+    Same output as `clean_text`, in three passes instead of six: lower case,
+    url removal, and one `str.translate` for punctuation, whitespace and 
+    non-printable characters (whitespace is collapsed by `split()`).
+    """
+    words = url_pattern.sub(' ', text.lower()).translate(_clean_table).split()
+    if remove_numeric:
+        words = [w for w in words if not w.isdigit()]
+    return words
+
+
+def _clean_chunk(texts, remove_numeric):
+    return [clean_text_fast(text, remove_numeric) for text in texts]
+
+
+def _tokenize_document(text):
+    return [clean_text_fast(s) for s in nltk.sent_tokenize(text)]
+
+
+def _chunks(iterable, chunksize):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def clean_texts(texts, n_jobs=1, chunksize=1000, remove_numeric=True):
+    """
+    Batch version of `clean_text`: lazily yields the token list of each text 
+    in `texts` (any iterable), in order. With `n_jobs` > 1, chunks of 
+    `chunksize` texts are cleaned in a process pool.
+    """
+    if n_jobs == 1:
+        for text in texts:
+            yield clean_text_fast(text, remove_numeric)
+        return
+    with multiprocessing.Pool(n_jobs) as pool:
+        clean = functools.partial(_clean_chunk, remove_numeric=remove_numeric)
+        for chunk in pool.imap(clean, _chunks(texts, chunksize)):
+            yield from chunk
+
+
+def tokenize_documents(texts, n_jobs=1, chunksize=16):
+    """
+    Lazily yield, for each text, its sentences (`nltk.sent_tokenize`) 
+    cleaned with `clean_text`; documents are spread over `n_jobs` processes.
+    """
+    if n_jobs == 1:
+        yield from map(_tokenize_document, texts)
+        return
+    with multiprocessing.Pool(n_jobs) as pool:
+        yield from pool.imap(_tokenize_document, texts, chunksize)
+
+
+class SentenceCorpus:
+    """
+    Restartable iterable over the cleaned sentences of `texts`.
+
+    The first pass sentence-splits and cleans the texts lazily, one text at a
+    time, and caches the result in `cache_filename` (one sentence per line, 
+    tokens separated by spaces -- `clean_text` tokens never contain 
+    whitespace). Every later pass streams the cache file instead, so `texts`
+    can be a one-shot generator (e.g. a chunked CSV reader). The first pass
+    uses `n_jobs` processes.
+
+    The hash of the texts the cache was built from is kept in 
+    `cache_filename` + ".sha256". A later run with the same `cache_filename`
+    reuses the cache only if `texts` can be iterated again (a list, a 
+    Series, ...) and hash the same; a one-shot generator can't be checked
+    without consuming it, so the cache is rebuilt.
+    """
+
+    # bump when the cleaning changes, to invalidate existing caches
+    version = 1
+
+    def __init__(self, texts, cache_filename, n_jobs=1):
+        self.texts = texts
+        self.cache_filename = cache_filename
+        self.n_jobs = n_jobs
+        self._checked = False
+
+    def _hash(self, texts):
+        # hashes each text as it is read; digest() once they are all read
+        h = hashlib.sha256(f"{type(self).__name__} {self.version}\n".encode("utf-8"))
+        for text in texts:
+            data = str(text).encode("utf-8")
+            h.update(len(data).to_bytes(8, "little"))
+            h.update(data)
+            yield text
+        self.digest = h.hexdigest()
+
+    def _cache_matches(self):
+        key_filename = self.cache_filename + ".sha256"
+        if not os.path.exists(self.cache_filename) or not os.path.exists(key_filename):
+            return False
+        if iter(self.texts) is self.texts:
+            print(f"{self.cache_filename}: texts can't be checked against the cache; rebuilding it")
+            return False
+        for _ in self._hash(self.texts):
+            pass
+        with open(key_filename, 'r') as f:
+            return f.read().strip() == self.digest
+
+    def _build(self):
+        key_filename = self.cache_filename + ".sha256"
+        tmp_filename = self.cache_filename + ".tmp"
+        with codecs.open(tmp_filename, 'w', encoding='utf-8') as f:
+            for sentences in tokenize_documents(self._hash(self.texts), self.n_jobs):
+                for words in sentences:
+                    f.write(' '.join(words) + '\n')
+        # drop the old key first, so that an interruption can't pair it with
+        # the new sentences
+        if os.path.exists(key_filename):
+            os.remove(key_filename)
+        os.replace(tmp_filename, self.cache_filename)
+        with open(key_filename, 'w') as f:
+            f.write(self.digest)
+
+    def __iter__(self):
+        if not self._checked:
+            if not self._cache_matches():
+                self._build()
+            self._checked = True
+        with codecs.open(self.cache_filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield line.split()
+
+
+class PhraseCorpus:
+    """
+    Phrase-merged sentences stored compactly on disk: all token ids in one 
+    int32 array (`tokens`), sentence boundaries in `offsets` (sentence i is 
+    tokens[offsets[i]:offsets[i + 1]]) and the id -> token list `words`. The
+    arrays are memory-mapped.
+
+    Iterating yields sentences as token lists, so it can be passed to 
+    `Word2Vec` directly; `subset(indices)` is a view over selected sentences
+    (e.g. a bootstrap sample) that shares the arrays.
+    """
+
+    def __init__(self, tokens, offsets, words, indices=None):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.words = words
+        self.indices = indices
+
+    @classmethod
+    def build(cls, sentences, bigrams, path, buffer_size=1 << 20):
+        """
+        Apply `bigrams` to each sentence (streamed from `sentences`) once and
+        write the encoded result to `path`, `buffer_size` tokens at a time.
+        """
+        os.makedirs(path, exist_ok=True)
+        word2id = {}
+        tokens, offsets = array.array('i'), array.array('q', [0])
+        n_written = 0
+        with open(os.path.join(path, "tokens.int32"), 'wb') as f_tokens, \
+                open(os.path.join(path, "offsets.int64"), 'wb') as f_offsets:
+            for sentence in sentences:
+                for w in bigrams[sentence]:
+                    tokens.append(word2id.setdefault(w, len(word2id)))
+                offsets.append(n_written + len(tokens))
+                if len(tokens) >= buffer_size:
+                    n_written += len(tokens)
+                    tokens.tofile(f_tokens)
+                    offsets.tofile(f_offsets)
+                    tokens, offsets = array.array('i'), array.array('q')
+            tokens.tofile(f_tokens)
+            offsets.tofile(f_offsets)
+        with codecs.open(os.path.join(path, "words.txt"), 'w', encoding='utf-8') as f:
+            # phrases contain spaces but never newlines
+            f.write('\n'.join(word2id))
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        with codecs.open(os.path.join(path, "words.txt"), 'r', encoding='utf-8') as f:
+            words = f.read().split('\n')
+        tokens_filename = os.path.join(path, "tokens.int32")
+        # np.memmap can't map an empty file
+        if os.path.getsize(tokens_filename):
+            tokens = np.memmap(tokens_filename, dtype=np.int32, mode='r')
+        else:
+            tokens = np.zeros(0, dtype=np.int32)
+        offsets = np.memmap(os.path.join(path, "offsets.int64"), dtype=np.int64, mode='r')
+        return cls(tokens, offsets, words)
+
+    def subset(self, indices):
+        return PhraseCorpus(self.tokens, self.offsets, self.words, indices)
+
+    def counts(self, chunk_size=1 << 24):
+        # occurrences of each token id, reading the token array in chunks
+        counts = np.zeros(len(self.words), dtype=np.int64)
+        for start in range(0, len(self.tokens), chunk_size):
+            counts += np.bincount(self.tokens[start:start + chunk_size], minlength=len(self.words))
+        return counts
+
+    def __len__(self):
+        return len(self.offsets) - 1 if self.indices is None else len(self.indices)
+
+    def __iter__(self):
+        words, tokens, offsets = self.words, self.tokens, self.offsets
+        indices = range(len(offsets) - 1) if self.indices is None else self.indices
+        for i in indices:
+            yield [words[t] for t in tokens[offsets[i]:offsets[i + 1]].tolist()]
+
+
+def _train_run(corpus_path, output_dir, run_idx, seed, bootstrap, dim, window, workers):
+    """Train and save one word2vec model on (a bootstrap sample of) the stored corpus."""
+    corpus = PhraseCorpus.load(corpus_path)
+    if bootstrap:
+        rng = np.random.default_rng(seed)
+        corpus = corpus.subset(rng.integers(0, len(corpus), len(corpus)))
+    print("Run #%d" % run_idx)
+    model = word2vec.Word2Vec(corpus, vector_size=dim, window=window, sg=1, min_count=5, workers=workers, seed=seed)
+    model.wv.save(os.path.join(output_dir, str(run_idx) + '.wv'))
+    return run_idx
+
+
+def main(
+        texts, output_dir="data/wv", bootstrap=True, num_runs=50, dim=100, window=5, 
+        n_jobs=1, workers=None, seed=None, store=None
+    ):
     """Runs word2vec training on data.
 
     Args:
-        texts: list of texts (should be cleaned)
+        texts: iterable of texts (should be cleaned); the cleaned 
+            sentences are cached in `output_dir`/sentences.txt and reused
+            by later runs with the same `output_dir` and texts (see
+            `SentenceCorpus`)
         bootstrap: whether to bootstrap sample from the sentences
+        n_jobs: number of processes for preprocessing, and number of runs 
+            trained at the same time
+        workers: word2vec threads per run; defaults to the cores divided 
+            by `n_jobs`
+        seed: base seed; each run's seed is derived from it and recorded in
+            `output_dir`/runs.json (a random base seed is drawn if None)
+        store: optional `corpus_store.CorpusStore`; sentences are then read
+            from its "clean" view (preprocessing only articles it doesn't 
+            have yet) instead of `output_dir`/sentences.txt
 
     """
     os.makedirs(output_dir, exist_ok=True)
 
-    all_sentences = []
-    for text in texts:
-        all_sentences.extend([clean_text(s) for s in nltk.sent_tokenize(text)])
-    # print(all_sentences)
+    # Stream sentences from disk instead of holding them in memory
+    if store is not None:
+        keys = store.add(texts, ("clean",), n_jobs)
+        all_sentences = store.view("clean").sentences(keys)
+    else:
+        all_sentences = SentenceCorpus(texts, os.path.join(output_dir, "sentences.txt"), n_jobs)
 
-    # Create model
-    bigrams = phrases.Phrases(all_sentences, min_count=5, delimiter=' ')
+    # Create model (the first pass over the texts also preprocesses them)
+    with metrics.timer("word2vec.phrases"):
+        bigrams = phrases.Phrases(all_sentences, min_count=5, delimiter=' ')
     # , common_terms=stopwords)
 
+    # Apply the phrases once; every run samples from this store
+    corpus_path = os.path.join(output_dir, "corpus")
+    with metrics.timer("word2vec.corpus_build"):
+        corpus = PhraseCorpus.build(all_sentences, bigrams.freeze(), corpus_path)
+    metrics.count("word2vec.sentences", len(corpus))
+
     # Create vocabulary of bigrams
     print("Creating vocabulary...")
-    vocab = [w for sent in bigrams[all_sentences] for w in sent]
-    vocab = [w for w, count in Counter(vocab).most_common() if count >= 5]
+    counts = corpus.counts()
+    # ids are in order of first appearance, so a stable sort keeps 
+    # Counter.most_common's tie order
+    vocab = [corpus.words[i] for i in np.argsort(-counts, kind="stable") if counts[i] >= 5]
 
     # Save vocab
     with codecs.open(os.path.join(output_dir, 'vocab.txt'), 'w', encoding='utf-8') as f:
         f.write('\n'.join(vocab))
 
     # Run word2vec model
-    all_sentences = np.asarray(all_sentences, dtype="object")
-    for run_idx in range(num_runs):
-        print("Run #%d" % run_idx)
-        if bootstrap:
-            # print(np.random.choice(np.asarray(all_sentences, dtype="object"), len(all_sentences), replace=True))
-
-            # data = bigrams[np.random.choice(all_sentences, len(all_sentences), replace=True)]
-            data = bigrams[np.random.choice(all_sentences, len(all_sentences), replace=True)]
-        else:
-            data = bigrams[all_sentences]
-        model = word2vec.Word2Vec(data, vector_size=dim, window=window, sg=1, min_count=5, workers=10)
-        model.wv.save(os.path.join(output_dir, str(run_idx) + '.wv'))
-
-
-
+    seed_sequence = np.random.SeedSequence(seed)
+    seeds = [int(s.generate_state(1)[0]) for s in seed_sequence.spawn(num_runs)]
+    with open(os.path.join(output_dir, 'runs.json'), 'w') as f:
+        json.dump({
+            "base_seed": seed_sequence.entropy, 
+            "bootstrap": bootstrap, 
+            "runs": [{"run": i, "seed": s} for i, s in enumerate(seeds)]
+        }, f, indent=2)
 
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // n_jobs)
+    args = [(corpus_path, output_dir, i, seeds[i], bootstrap, dim, window, workers) for i in range(num_runs)]
+    if n_jobs == 1:
+        for a in args:
+            with metrics.timer("word2vec.run"):
+                _train_run(*a)
+            metrics.count("word2vec.runs")
+    else:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            for _ in pool.map(_train_run, *zip(*args)):
+                metrics.count("word2vec.runs")